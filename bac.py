@@ -5,9 +5,12 @@ from itertools import izip_longest, product
 from math import ceil
 from struct import pack, unpack
 from StringIO import StringIO
-from wii_lz77 import WiiLZ77
+from codec import decompress_many, map_file
+from palette import decode_palette
 from PIL import Image
-from lz77 import compress
+from tiledata import arrange_tiles, decode_tiles, tiles_to_images
+import lzcache
+from lz77 import compress_auto, compress_bytes, AUTO_FORMATS, GREEDY, LAZY, OPTIMAL
 
 # Attributes from sprite.h of libnds
 # Attribute 0 consists of 8 bits of Y plus the following flags:
@@ -27,7 +30,7 @@ size_square = [(8, 8), (16, 16), (32, 32), (64, 64)]
 size_wide = [(16, 8), (32, 8), (32, 16), (64, 32)]
 size_tall = [(8, 16), (8, 32), (16, 32), (32, 64)]
 
-def bac_to_images(bac, debug=False):
+def bac_to_images(bac, debug=False, workers=None):
     # Skip 4 bytes
     bac.seek(4)
     (animation_mappings_offset, animation_frames_offset, frame_assembly_offset, palette_offset,
@@ -61,6 +64,7 @@ def bac_to_images(bac, debug=False):
     frames = []
     images = []
     parts = {}
+    palette_blocks = []
     
     for frame_index, frame_offset in enumerate(animation_mappings):
         bac.seek(animation_frames_offset + frame_offset)
@@ -111,8 +115,7 @@ def bac_to_images(bac, debug=False):
                 print block_id
                 bac.seek(block_size - 4, 1)            
         
-        palette_data = read_compressed(bac, palette_offset + palette_part[0])
-        palette = load_palette(palette_data)
+        palette_blocks.append(palette_offset + palette_part[0])
                 
         # Get frame assembly info
         bac.seek(frame_assembly_offset + frame_assembly_part_offset)
@@ -134,15 +137,9 @@ def bac_to_images(bac, debug=False):
         
         frame_width = frame_x_right - frame_x
         frame_height = frame_y_bottom - frame_y
-    
-        frame_image = Image.new('P', (frame_width, frame_height))
-        frame_image.putpalette(palette)
         
-        # Now read image tiles and compose image part
+        # Find out where each image part goes
         for part_index, part in enumerate(frame_parts):
-            data = read_compressed(bac, data_offset + part[0])
-            tiles = load_tiles(data, 1)
-            
             attr_0, attr_1, attr_2 = image_part_info[part_index][:3]            
             
             part_y = attr_0 & 0xFF
@@ -161,86 +158,40 @@ def bac_to_images(bac, debug=False):
                 width, height = size_square[size]
 
             part.append((part_x, part_y, width, height))                                   
-            tiles_per_row = width / 8
             
             #print image_part_info[part_index], part_y, part_x, size, width, height #width, len(tiles), tiles_per_row
             
-            image = Image.new('P', (width, height))
-            #image.putpalette(palette)
-            
-            for index, tile in enumerate(tiles):
-                image.paste(tile, ((index % tiles_per_row) * 8, (index / tiles_per_row) * 8))
-
-            frame_image.paste(image, (part_x, part_y))
-            
         if debug:
             print ''
         
         frames.append((frame_width, frame_height, frame_parts, frame_parts_offsets))        
-        images.append(frame_image)
-            
-    return images, frames
     
-def read_compressed(bac, offset):
-    # Decompress data
-    bac.seek(offset)
-    
-    header = unpack("<I", bac.read(4))[0]    
-    compression_type, uncompressed_length = header & 0xFF, header >> 8
-            
-    if compression_type == 0:
-        # Uncompressed
-        return bac.read(uncompressed_length)
-    elif compression_type == 0x10:
-        return WiiLZ77(bac, offset).uncompress()
-    else:
-        raise ValueError
-        
-def load_palette(palette_data):
-    bgr_colors = list(izip_longest(*[iter(palette_data)] * 2))
+    # Decompress palettes and image parts of all frames at once
+    parts_blocks = [data_offset + part[0] for frame in frames for part in frame[2]]
+    data = map_file(bac)
+    try:
+        blocks = decompress_many(data, palette_blocks + parts_blocks, workers)
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
     
-    palette = []
-    #transparency = None
-
-    for color in bgr_colors:
-        color = int(''.join(reversed(color)).encode('hex'), 16)
-        color = (color & 31, (color & 31 << 5) >> 5, (color & 31 << 10) >> 10)
-        red, green, blue = [int(n*(255 / 31.0)) for n in color]
-        palette += [red, green, blue]
-        
-    #palette.extend([255, 0, 255]*(256-16))
+    for (frame_width, frame_height, frame_parts, frame_parts_offsets), palette_block in zip(frames, palette_blocks):
+        frame_image = Image.new('P', (frame_width, frame_height))
+        frame_image.putpalette(decode_palette(blocks[palette_block]))
         
-    return palette
+        # Now compose image parts from their tiles
+        for offset, tiles_count, (part_x, part_y, width, height) in frame_parts:
+            tiles = decode_tiles(blocks[data_offset + offset], 1)
+            image = arrange_tiles(tiles, width, height)
+            frame_image.paste(image, (part_x, part_y))
+            
+        images.append(frame_image)
+            
+    return images, frames
     
 def load_tiles(data, color_format):
     # Load tiles
-    tiles = []
-    
-    if color_format == 1:
-        bytes_per_tile = 32
-    else:
-        bytes_per_tile = 64
-
-    for tile_data in izip_longest(*[iter(data)] * bytes_per_tile):
-        # Get color index for each pixel
-        pixels = []
-        for pixel in tile_data:
-            value = ord(pixel)
-            
-            if color_format == 1:
-                second = (value & 0xF0) >> 4
-                first = value & 0x0F 
-                pixels += [first, second]
-            elif color_format == 2:
-                pixels.append(value)
-
-        # Create new image and load tile data
-        tile = Image.new('P', (8, 8))
-        tile.putdata(pixels)
-        #tile.putpalette(temp_palette())
-        tiles.append(tile)
-        
-    return tiles   
+    return tiles_to_images(decode_tiles(data, color_format))
 
 def image_to_tiles(image):
     tiles = [image.crop((x, y, x + 8, y + 8))
@@ -289,14 +240,26 @@ if __name__ == '__main__':
     parser.add_argument('files', help='files to work with', type=argparse.FileType('r+b'), nargs="+")
     parser.add_argument('-u', '--update', metavar='frame', help='update frames\' parts from images', type=argparse.FileType('r+b'), nargs="+")
     parser.add_argument('-d', '--debug', action='store_true', help='debug mode')
+    parser.add_argument('-j', '--jobs', help='number of processes to decompress with', type=int)
+    parser.add_argument('-l', '--level', help='compression level: 0 - greedy, 1 - lazy, 2 - optimal', type=int,
+        choices=(GREEDY, LAZY, OPTIMAL), default=GREEDY)
+    parser.add_argument('-c', '--codec', help='parts\' data format, auto picks one for each part by estimated size',
+        choices=AUTO_FORMATS + ('auto',), default='lz10')
+    parser.add_argument('--max-chain', help='most candidates each match search looks at, faster but larger '
+        'output, all of them by default', type=int)
+    parser.add_argument('--prefer', help='what auto codec selection optimizes for', choices=('size', 'speed'), default='size')
+    parser.add_argument('--no-cache', help="don't use the cache of compressed blocks", action='store_true')
 
     args = parser.parse_args()
+
+    if args.no_cache:
+        lzcache.disable()
     
     if not args.update:
         for input_file in args.files:    
             # Single image file
             try:
-                images, frames = bac_to_images(input_file, args.debug)
+                images, frames = bac_to_images(input_file, args.debug, args.jobs)
             except Exception as e:
                 print '{} while loading {}'.format(e, input_file.name)
                 #raise
@@ -319,14 +282,20 @@ if __name__ == '__main__':
         (animation_mappings_offset, animation_frames_offset, frame_assembly_offset, palette_offset,
             data_offset, info_offset) = unpack('<6i', bac.read(24))        
         
-        images, frames = bac_to_images(bac, args.debug)
+        images, frames = bac_to_images(bac, args.debug, args.jobs)
         parts_offsets = []
         
         for frame_width, frame_height, frame_parts, frame_parts_offset in frames:
             parts_offsets.extend([part[0] for part in frame_parts])
         parts_offsets = sorted(set(parts_offsets))    
             
-        parts_data = [read_compressed(bac, data_offset + part) for part in parts_offsets]
+        data = map_file(bac)
+        try:
+            blocks = decompress_many(data, [data_offset + part for part in parts_offsets], args.jobs)
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+        parts_data = [blocks[data_offset + part] for part in parts_offsets]
         
         updated_parts = []           
         
@@ -427,7 +396,14 @@ if __name__ == '__main__':
             
             #bac.write(pack('<I', len(data) << 8))
             #bac.write(data)
-            compress(data, bac)
+            if args.codec == 'auto':
+                codec, compressed, estimates = compress_auto(data, prefer=args.prefer, level=args.level,
+                    max_chain=args.max_chain)
+                print 'Part {} stored as {}, {} bytes (estimated: {})'.format(index, codec, len(compressed),
+                    ', '.join('{} {}'.format(fmt, estimates[fmt]) for fmt in AUTO_FORMATS))
+            else:
+                compressed = compress_bytes(data, args.codec, args.level, max_chain=args.max_chain)
+            bac.write(compressed)
             
             #try:
                 #if bac.tell() - data_offset < parts_offsets[index + 1]:
@@ -452,3 +428,6 @@ if __name__ == '__main__':
                 
                 for offset, tiles_count, dimensions in frame_parts:
                     bac.write(pack('<II', new_offsets[parts_offsets.index(offset)], tiles_count))
+
+        if lzcache.stats():
+            print lzcache.stats()
@@ -1,34 +1,154 @@
 #!/usr/bin/python2
 import argparse
 import os.path
-from collections import namedtuple
-from itertools import izip_longest
+import sys
+from array import array
+from collections import namedtuple, OrderedDict
+from itertools import izip, izip_longest
 from math import ceil
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from StringIO import StringIO
 from PIL import Image
-from wii_lz77 import WiiLZ77
+from codec import map_file, read_compressed
+from palette import decode_palette
+from tiledata import (canonical_keys, compose_map, decode_tiles, image_tiles, order_tiles, sample_grid,
+    sample_map, tiles_to_images, HAVE_NUMPY)
 import lz77
+import lzcache
 
 BBGHeader = namedtuple('BBGHeader', ('size', 'data_offset', 'mappings_offset', 'palette_offset',
             'color_format', 'row_len', 'rows_n', 'bbg_palette_index', 'unknown'))
 
+# BBGs of a BB that could use one tileset, how many tiles they store, how many
+# of those are distinct and how many bytes of tile data sharing would save
+SharedTiles = namedtuple('SharedTiles', ('entries', 'tiles_n', 'unique_n', 'saved'))
+
+class MappingEntry(object):
+    """Fields of a 16-bit screen entry: tile number, flips and palette bank"""
+    __slots__ = ('value',)
+    
+    def __init__(self, value=0):
+        self.value = value
+        
+    @property
+    def tile(self):
+        return self.value & 0x03FF
+        
+    @property
+    def flip_h(self):
+        return bool(self.value & 0x400)
+        
+    @property
+    def flip_v(self):
+        return bool(self.value & 0x800)
+        
+    @property
+    def bank(self):
+        return self.value >> 12
+        
+    @staticmethod
+    def pack(tile, flip_h=False, flip_v=False, bank=0):
+        """Returns the value of an entry with the given fields"""
+        return tile | flip_h << 10 | flip_v << 11 | bank << 12
+
+class Mappings(object):
+    """Screen entries of a BBG map, kept in one array of 16-bit values"""
+    __slots__ = ('words',)
+    
+    def __init__(self, data=''):
+        self.words = array('H')
+        self.words.fromstring(data[:len(data) // 2 * 2])
+        if sys.byteorder == 'big':
+            self.words.byteswap()
+            
+    def __len__(self):
+        return len(self.words)
+        
+    def __getitem__(self, index):
+        return MappingEntry(self.words[index])
+        
+    def __iter__(self):
+        return (MappingEntry(value) for value in self.words)
+        
+    def append(self, tile, flip_h=False, flip_v=False, bank=0):
+        self.words.append(MappingEntry.pack(tile, flip_h, flip_v, bank))
+        
+    def tobytes(self):
+        """Returns the entries as they are stored in BBGs"""
+        if sys.byteorder == 'big':
+            words = array('H', self.words)
+            words.byteswap()
+            return words.tostring()
+        return self.words.tostring()
+
+def section(offset_field):
+    """A BBG section, decompressed from the offset in the header field
+    offset_field on first access"""
+    name = '_' + offset_field
+    
+    def get(self):
+        if name not in self.__dict__:
+            # New BBGs have nothing to read until they are updated
+            if self.loaded:
+                self.__dict__[name] = read_compressed(self.bbg, getattr(self.header, offset_field))
+            else:
+                self.__dict__[name] = None
+        return self.__dict__[name]
+    
+    def set(self, value):
+        self.__dict__[name] = value
+        
+    return property(get, set)
+
+# Palettes of external palette files, by file name and palette offset
+palettes = {}
+
+def load_palette(bbg_palette):
+    """Returns the palette data and RGB palette of the BBG in bbg_palette,
+    read once per process"""
+    bbg_palette.seek(0)
+    bbg = BBG(bbg_palette)
+
+    # A file object without a file name, e.g. one in memory, can't be told
+    # apart from others, so its palette isn't kept
+    name = getattr(bbg_palette, 'name', None)
+    key = (os.path.abspath(name), bbg.header.palette_offset) if isinstance(name, basestring) else None
+    
+    if key not in palettes:
+        palette_data = bbg.palette_data
+        palette = (palette_data, decode_palette(palette_data) if palette_data else temp_palette())
+        if key is None:
+            return palette
+        palettes[key] = palette
+        
+    return palettes[key]
+
 class BBG(object):
     """A class for converting BBG image into PNG and importing it back"""
     def __init__(self, bbg, header=None):
         self.bbg = bbg
         self.header = header
+        # Whether sections can be read from bbg
+        self.loaded = not header
         
         if not self.header:
             # Skip 4 bytes
             assert bbg.read(4) == 'BBG\00'
             self.header = header = BBGHeader(*unpack('<5i4h', bbg.read(28)))
             
-            self.data = read_compressed(bbg, header.data_offset)
-            self.mappings_data = read_compressed(bbg, header.mappings_offset)
-            self.palette_data = read_compressed(bbg, header.palette_offset)
+    # Sections are only decompressed when used
+    data = section('data_offset')
+    mappings_data = section('mappings_offset')
+    palette_data = section('palette_offset')
+    
+    @property
+    def mappings(self):
+        """Screen entries of the map"""
+        return Mappings(self.mappings_data or '')
 
-    def to_image(self, bbg_palette=None):
+    def to_image(self, bbg_palette=None, region=None, thumbnail=None):
+        """Draws the BBG, or only its region=(x, y, w, h) in pixels, scaled
+        down to fit within thumbnail=(width, height) if given"""
         bbg = self.bbg
         (size, data_offset, mappings_offset, palette_offset,
             color_format, row_len, rows_n, bbg_palette_index, unknown) = self.header
@@ -55,113 +175,87 @@ class BBG(object):
         tiles_n = len(data) / bytes_per_tile
         print('Tiles count: {}'.format(tiles_n)) 
         
-        # Load tiles
-        tiles = []
-        temp_i = 0
-        for tile_data in izip_longest(*[iter(data)] * bytes_per_tile):
-            # Get color index for each pixel
-            pixels = []
-            for pixel in tile_data:
-                value = ord(pixel)
-                
-                if color_format == 1:
-                    second = (value & 0xF0) >> 4
-                    first = value & 0x0F 
-                    pixels += [first, second]
-                elif color_format == 2:
-                    pixels.append(value)
-
-            # Create new image and load tile data
-            tile = Image.new('P', (8, 8))
-            tile.putdata(pixels)
-            #tile.putpalette(temp_palette())
-            tiles.append(tile)
-            temp_i += 1
-            
         # Load mappings
         mappings_data = self.mappings_data # read_compressed(bbg, mappings_offset)
         # Use value of first tile as offset, 4 bits of first byte are palette index
-        self.vram_offset = offset = unpack('<H', mappings_data[0:2])[0] & 0x03FF - 1
+        self.vram_offset = offset = self.tile_offset()
         
-        mappings = []
-
-        for tile in izip_longest(*[iter(mappings_data)] * 2):
-            value = unpack('<H', tile[0] + tile[1])[0]
-            palette_index = value >> 12
-            vram_n = value & 0x03FF
-            n = vram_n - offset
-            flip_h = bool(value & 0x400)
-            flip_v = bool(value & 0x800)
-            mappings.append((n, flip_h, flip_v, palette_index))
-            
         # Load palette
         if bbg_palette:
-            palette_data = BBG(bbg_palette).palette_data
+            palette_data, palette = load_palette(bbg_palette)
         else:    
             palette_data = self.palette_data
+            palette = decode_palette(palette_data) if palette_data else temp_palette()
         
         palette_index = bbg_palette_index >> 4
         print 'VRAM offset, palette_index: {} {}'.format(offset, palette_index)
         
-        if palette_data:
-            bgr_colors = list(izip_longest(*[iter(palette_data)] * 2))
-            
-            palette = []
-            #transparency = None
-
-            for color in bgr_colors:
-                color = int(''.join(reversed(color)).encode('hex'), 16)
-                color = (color & 31, (color & 31 << 5) >> 5, (color & 31 << 10) >> 10)
-                red, green, blue = [int(n*(255 / 31.0)) for n in color]
-                palette += [red, green, blue]
-                #if [red, green, blue] == [248, 0, 248] and transparency == None:
-                #    transparency = (len(palette)/3)-1
+        if region or thumbnail:
+            # Decode only the pixels shown
+            xs, ys = sample_grid(row_len * 8, rows_n * 8, region, thumbnail)
+            result = sample_map(data, color_format, mappings_data, offset, row_len, rows_n, xs, ys,
+                palette_index if palette_data else None)
+        elif HAVE_NUMPY:
+            # Draw the whole map at once
+            result = compose_map(decode_tiles(data, color_format), mappings_data, offset, row_len, rows_n,
+                palette_index if palette_data else None)
         else:
-            palette = temp_palette()
+            result = self.draw_mappings(tiles_to_images(decode_tiles(data, color_format)), mappings_data,
+                offset, row_len, rows_n, palette_index, palette_data)
         
-        # Create new image to draw mappings
-        result = Image.new('P', (row_len * 8, rows_n * 8))
         result.putpalette(palette)
         if palette_index:
             result.info["palette_index"] = str(palette_index)
             result.info["palette_count"] = str(len(palette) / 48)
         
-        rows = list(izip_longest(*[iter(mappings)] * row_len))
-
+        return result
+    
+    def tile_offset(self):
+        """Returns the VRAM tile number of the first tile, from the first
+        mapping entry"""
+        return unpack('<H', self.mappings_data[0:2])[0] & 0x03FF - 1
+        
+    def draw_mappings(self, tiles, mappings_data, offset, row_len, rows_n, palette_index, palette_data):
+        """Pastes tile images one by one as specified in mappings"""
+        # Create new image to draw mappings
+        result = Image.new('P', (row_len * 8, rows_n * 8))
+        
         # Put tiles to image as specified in mappings
-        for row in range(0, len(rows)):
-            for tile in range(0, len(rows[row])):
-                entry = rows[row][tile]
+        for index, entry in enumerate(Mappings(mappings_data)):
+            row, tile = divmod(index, row_len)
+            
+            try:
+                image = tiles[entry.tile - offset]
+            except IndexError:
+                continue
+            
+            # Flip horizontally
+            if entry.flip_h:
+                image = image.transpose(Image.FLIP_LEFT_RIGHT)
+            # Flip vertically
+            if entry.flip_v:
+                image = image.transpose(Image.FLIP_TOP_BOTTOM)
+            
+            # Try to fix colors for images with more than one palette based on palette index
+            if palette_data and palette_index < entry.bank:
+                # Calculate offset of tile's palette in result one
+                tile_palette_offset = (entry.bank - palette_index) * 16
+                pixels = [pixel + tile_palette_offset for pixel in image.getdata()]
                 
-                if entry:
-                    try:
-                        image = tiles[entry[0]]
-                    except IndexError:
-                        continue
-                    
-                    # Flip horizontally
-                    if entry[1]:
-                        image = image.transpose(Image.FLIP_LEFT_RIGHT)
-                    # Flip vertically
-                    if entry[2]:
-                        image = image.transpose(Image.FLIP_TOP_BOTTOM)
-                    
-                    # Try to fix colors for images with more than one palette based on palette index
-                    if palette_data and palette_index < entry[3]:
-                        # Calculate offset of tile's palette in result one
-                        tile_palette_offset = (entry[3] - palette_index) * 16
-                        pixels = [pixel + tile_palette_offset for pixel in image.getdata()]
-                        
-                        image = Image.new('P', (8, 8))
-                        image.putdata(pixels)
-                        
-                    result.paste(image, (tile * 8, row * 8))
+                image = Image.new('P', (8, 8))
+                image.putdata(pixels)
+                
+            result.paste(image, (tile * 8, row * 8))
         
         return result
         
-    def update(self, image, vram_offset=0, empty=False, compress=True):
+    def update(self, image, vram_offset=0, empty=False, compress=True, level=None,
+            codec=None, prefer='size', reorder=False, max_chain=None):
         if not vram_offset:
             vram_offset = getattr(self, 'vram_offset', 0)
+            
+        # Read the palette before its section gets overwritten
+        palette_data = self.palette_data
 
         # First tile - empty tile?
         if empty:
@@ -170,48 +264,36 @@ class BBG(object):
         else:
             tiles = []
         
+        # Index of the packed bytes of each tile kept so far, so duplicates
+        # are found without scanning the whole list
+        index = dict((bytes(bytearray(data)), n) for n, data in enumerate(tiles))
+        
         mappings = []    
         reused = 0    
         
-        transforms = (
-            (None, False, False),
-            (Image.FLIP_LEFT_RIGHT, True, False),
-            (Image.FLIP_TOP_BOTTOM, False, True),
-            (Image.ROTATE_180, True, True),
-        )
-        
-        # Iterate over top-left coordinates of each tile and split image to 8x8 tiles
-        for y in range(0, image.size[1], 8):
-            for x in range(0, image.size[0], 8):
-                # Crop image to 8x8 tile
-                tile = image.crop((x, y, x + 8, y + 8))
+        # Variants of each tile tried, in order. Horizontal flips alone are
+        # left out as they always were: Image.FLIP_LEFT_RIGHT is 0, so the
+        # transpose loop this replaces never applied it
+        flips = ((0, False, False), (2, False, True), (3, True, True))
+        
+        # Split image to 8x8 tiles, each with its horizontally/vertically/both
+        # flipped variants
+        for variants in image_tiles(image):
+            # Try to find tile duplicates, fliping vertically/both if necessary
+            for variant, flip_h, flip_v in flips:
+                n = index.get(variants[variant])
+                if n is not None:
+                    mappings.append((n, flip_h, flip_v))
+                    reused += 1
+                    break
+                
+            else:
+                n = len(tiles)
+                
+                index[variants[0]] = n
+                tiles.append(list(bytearray(variants[0])))
+                mappings.append((n, False, False))
                 
-                # Try to find tile duplicates, fliping horizontally/vertically/both if necessary
-                for method, flip_h, flip_v in transforms:
-                    if method:
-                        transposed = tile.transpose(method)
-                    else:
-                        transposed = tile
-                        
-                    data = list(transposed.getdata())
-                    
-                    # Try to tile duplicate
-                    try:
-                        n = tiles.index(data)
-                    except ValueError:
-                        pass
-                    else:
-                        mappings.append((n, flip_h, flip_v))
-                        reused += 1
-                        break
-                    
-                else:
-                    data = list(tile.getdata())
-                    n = len(tiles)
-                    
-                    tiles.append(data)
-                    mappings.append((n, False, False))
-                    
         #assert reused + len(tiles) == len(mappings) + 1   
         print '{} tiles reused, {} in result'.format(reused, len(tiles), len(mappings))    
         
@@ -219,6 +301,16 @@ class BBG(object):
         bbg = self.bbg        
         (size, data_offset, mappings_offset, palette_offset,
             color_format, row_len, rows_n, bbg_palette_index, unknown) = self.header
+        
+        # Compressed spans of the sections as loaded with what they decode
+        # to, sections that come out the same are copied as they were
+        spans = {}
+        if self.loaded and data_offset < mappings_offset < palette_offset < size:
+            for name, start, end in (('data', data_offset, mappings_offset),
+                    ('mappings_data', mappings_offset, palette_offset), ('palette_data', palette_offset, size)):
+                value = getattr(self, name)
+                bbg.seek(start)
+                spans[name] = (value, bbg.read(end - start))
             
         # Write tile data
         data_offset = 0x20
@@ -231,10 +323,11 @@ class BBG(object):
             data_length = len(tiles) * (8 * 8)
             
         
-        data = []
+        tiles_data = []
         palette_indexes = []
         
         for tile in tiles:
+            data = []
             if color_format == 1:
                 # Hack for 4 bpp images with multiple palettes
                 palette_index = tile[0] // 16
@@ -247,46 +340,80 @@ class BBG(object):
                     data.append(chr(value))
             else:
                 data += map(chr, tile)
+            tiles_data.append(''.join(data))
         
+        data = ''.join(tiles_data)
         assert len(data) == data_length        
 
-        if compress:
-            lz77.compress(data, bbg)
+        if not compress:
+            codec = 'raw'
+
+        # Unchanged tile data keeps its compressed span unless a level, a chain
+        # depth or another codec than the span's was asked for. Otherwise tile data is
+        # stored as greedy LZ10 by default
+        keep = 'data' in spans and level is None and max_chain is None and (codec is None or
+            lz77.FORMATS.get(codec, (None,))[0] == ord(spans['data'][1][0]))
+        if codec is None:
+            codec = 'lz10'
+        if level is None:
+            level = lz77.GREEDY
+            
+        if reorder and codec != 'raw' and mappings:
+            # Tiles up to the one of the first entry stay, it gives the VRAM
+            # offset when extracting
+            order = order_tiles(tiles_data, mappings[0][0] + 1)
+            reordered = ''.join(tiles_data[n] for n in order)
+            
+            # Keep whichever order compresses better
+            fmt = 'lz10' if codec == 'auto' else codec
+            if lz77.estimate_size(reordered, fmt) < lz77.estimate_size(data, fmt):
+                position = dict((n, i) for i, n in enumerate(order))
+                mappings = [(position[n], flip_h, flip_v) for n, flip_h, flip_v in mappings]
+                palette_indexes = [palette_indexes[n] for n in order] if palette_indexes else palette_indexes
+                data = reordered
+                print 'Tiles reordered'
+
+        if keep and spans['data'][0] == data:
+            compressed = spans['data'][1]
+            print 'Tile data unchanged'
+        elif codec == 'auto':
+            codec, compressed, estimates = lz77.compress_auto(data, prefer=prefer, level=level, max_chain=max_chain)
+            print 'Tile data stored as {}, {} bytes (estimated: {})'.format(codec, len(compressed),
+                ', '.join('{} {}'.format(fmt, estimates[fmt]) for fmt in lz77.AUTO_FORMATS))
         else:
-            bbg.write(pack('<i', data_length << 8))
-            bbg.write(''.join(data))
+            compressed = lz77.compress_bytes(data, codec, level, max_chain=max_chain)
+        bbg.write(compressed)
         
         # Write mappings    
         mappings_offset = bbg.tell()    
         
         mappings_length = len(mappings) * 2
-        bbg.write(pack('<i', mappings_length << 8))
         
         palette_index = bbg_palette_index >> 4
-        mappings_data = []
+        mappings_data = Mappings()
         
         for n, flip_h, flip_v in mappings:
-            # Calculate vram tile offset
-            value = n + vram_offset
-            # Add palette index
-            #value |= bbg_palette_index << 8# 12
-            value |= (palette_index + palette_indexes[n]) << 12
-            # Set flip_h and flip_v flags
-            value |= flip_h << 10
-            value |= flip_v << 11
-            
-            # Pack value
-            value = pack('<H', value)
-            mappings_data.append(value)
-            
-        assert len(mappings_data) * 2 == mappings_length
-        bbg.write(''.join(mappings_data))
+            # Calculate vram tile offset and add palette index, 8 bpp tiles
+            # have no palette banks of their own
+            bank = palette_index + (palette_indexes[n] if palette_indexes else 0)
+            mappings_data.append(n + vram_offset, flip_h, flip_v, bank)
+            
+        mappings_data = mappings_data.tobytes()
+        assert len(mappings_data) == mappings_length
+        
+        if 'mappings_data' in spans and spans['mappings_data'][0] == mappings_data:
+            bbg.write(spans['mappings_data'][1])
+        else:
+            bbg.write(pack('<i', mappings_length << 8))
+            bbg.write(mappings_data)
 
         # Write palette
         palette_offset = bbg.tell()
-        if self.palette_data:
-            bbg.write(pack('<i', len(self.palette_data) << 8))
-            bbg.write(self.palette_data)
+        if 'palette_data' in spans and spans['palette_data'][0] == palette_data:
+            bbg.write(spans['palette_data'][1])
+        elif palette_data:
+            bbg.write(pack('<i', len(palette_data) << 8))
+            bbg.write(palette_data)
         else:
             bbg.write('\x00' * 4)
         
@@ -305,63 +432,272 @@ class BBG(object):
         
         #bbg.write(pack('<5i2h', size, data_offset, mappings_offset, palette_offset, unknown, row_len, rows_n))  
         bbg.write(pack('<5i4h', *self.header))
+        
+        # Sections now hold what was written
+        self.data = data
+        self.mappings_data = mappings_data
+        self.loaded = True
+
+class BBReader(object):
+    """Entries of a BB file mapped into memory. Only the table of their
+    offsets and sizes is read up front, entries are sliced when used."""
+    def __init__(self, bb):
+        self.file = bb
+        self.data = map_file(bb)
+        
+        # Read num of files and files info
+        n_files = unpack_from('<i', self.data, 0x4)[0]
+        self.table = [unpack_from('<ii', self.data, 0x8 + n * 8) for n in range(n_files)]
+        
+        try:
+            self.view = memoryview(self.data)
+        except TypeError:
+            # Python 2 mmaps only have the old buffer interface
+            self.view = None
+            
+    def __len__(self):
+        return len(self.table)
+        
+    def __getitem__(self, n):
+        """Returns entry n without copying it"""
+        offset, size = self.table[n]
+        if self.view is None:
+            return buffer(self.data, offset, size)
+        return self.view[offset:offset + size]
+        
+    def __iter__(self):
+        return (self[n] for n in range(len(self)))
+        
+    def read(self, n):
+        """Returns a copy of entry n as a byte string"""
+        offset, size = self.table[n]
+        return self.data[offset:offset + size]
 
 class BB(object):
     """A class for working with multiple BBGs stored in one BB file"""
     def __init__(self, bb, contents=[]):
-        self.contents = contents[:]
+        self._contents = contents[:] or None
+        self.entries = None
+        # BBGs replaced by number, while contents aren't read
+        self.changed = {}
         
-        if not self.contents:        
-            # Read num of files
-            bb.seek(0x4)
-            n_files = unpack('<i', bb.read(4))[0]
+        if self._contents is None:
+            self.entries = BBReader(bb)
+            
+    @property
+    def contents(self):
+        """List of the data of all BBGs, read from the file on first use"""
+        if self._contents is None:
+            self._contents = [self.read(n) for n in range(len(self.entries))]
+        return self._contents
+        
+    def __len__(self):
+        if self._contents is None:
+            return len(self.entries)
+        return len(self._contents)
+        
+    def read(self, n):
+        """Returns the data of BBG n"""
+        if self._contents is None:
+            if n in self.changed:
+                return self.changed[n]
+            return self.entries.read(n)
+        return self._contents[n]
+        
+    def shared_tiles(self):
+        """Finds groups of BBGs that could share one tileset, those with the
+        same VRAM tile offset, color format and palette. Tiles that only differ
+        by flips count as the same. Returns a SharedTiles for each group."""
+        groups = OrderedDict()
+        
+        for n in range(len(self)):
+            bbg = BBG(StringIO(self.read(n)))
+            (size, data_offset, mappings_offset, palette_offset,
+                color_format, row_len, rows_n, bbg_palette_index, unknown) = bbg.header
             
-            # Extract contents
-            for n in range(n_files):
-                offset, size = unpack('<ii', bb.read(8))
-                current = bb.tell()
+            if color_format == 5:
+                color_format = 2
+            if color_format not in (1, 2) or not bbg.data or len(bbg.mappings_data) < 2:
+                continue
                 
-                # Read file's data
-                bb.seek(offset)
-                self.contents.append(bb.read(size))
+            key = (bbg.tile_offset(), color_format, bbg_palette_index, bbg.palette_data)
+            groups.setdefault(key, []).append((n, decode_tiles(bbg.data, color_format)))
+            
+        result = []
+        for (offset, color_format, bbg_palette_index, palette_data), members in groups.items():
+            if len(members) < 2:
+                continue
+            
+            tiles_n = 0
+            keys = set()
+            for n, tiles in members:
+                tiles_n += len(tiles)
+                keys.update(canonical_keys(tiles))
                 
-                bb.seek(current)
+            tile_size = 32 if color_format == 1 else 64
+            result.append(SharedTiles([n for n, tiles in members], tiles_n, len(keys),
+                (tiles_n - len(keys)) * tile_size))
+            
+        return result
+    
+    def __setitem__(self, n, data):
+        """Replaces the data of BBG n"""
+        self.changed[n] = data
+        if self._contents is not None:
+            self._contents[n] = data
+            
+    def changes(self):
+        """Returns the data of the BBGs that differ from the file, by number"""
+        if self._contents is None:
+            return self.changed
+        
+        # The list may have been changed directly
+        return dict((n, data) for n, data in enumerate(self._contents)
+            if self.entries is None or n >= len(self.entries) or data != self.entries.read(n))
+            
+    def fits(self):
+        """Whether the file can be patched: the same number of BBGs, with the
+        changed ones no larger than the ones they replace"""
+        if self.entries is None or len(self) != len(self.entries):
+            return False
+        return all(len(data) <= self.entries.table[n][1] for n, data in self.changes().items())
                 
-    def save(self, bb):
-        """Save modified BB contents to a new file"""        
-        bb.write('BB\x00\x00')
-        # Write len of files
-        bb.write(pack('<i', len(self.contents)))
-        
-        # Write files info and data
-        offset = len(self.contents) * 8 + 8
-        
-        for bbg in self.contents:
-            # Write info
-            bb.write(pack('<ii', offset, len(bbg)))
-            next_entry = bb.tell()
+    def save(self, bb, patch=False):
+        """Save modified BB contents to a new file. With patch, if changed
+        BBGs fit in the space of the original ones, the original file is copied
+        and only they and their entries in the table are written."""
+        if patch and self.fits():
+            self.patch(bb)
+        elif self._contents is None:
+            # Unchanged BBGs are written straight from the mapped file
+            write_bb(bb, [self.changed.get(n, self.entries[n]) for n in range(len(self))])
+        else:
+            write_bb(bb, self._contents)
+            
+    def patch(self, bb):
+        """Writes the file with changed BBGs in place of the original ones"""
+        source = self.entries.file
+        if not same_file(source, bb):
+            bb.seek(0)
+            copy_file(source, bb, len(self.entries.data))
+            
+        for n, data in sorted(self.changes().items()):
+            offset, size = self.entries.table[n]
             
+            # Clear what's left of the old BBG
             bb.seek(offset)
-            bb.write(bbg)
-            offset = bb.tell()
+            bb.write(data)
+            bb.write('\x00' * (size - len(data)))
             
-            bb.seek(next_entry)
-        
+            bb.seek(0x8 + n * 8)
+            bb.write(pack('<ii', offset, len(data)))
+            
+def write_bb(bb, contents):
+    """Writes a BB file of the BBGs in contents in one pass: the table of
+    offsets and sizes is worked out before anything is written"""
+    # Files data follows files info
+    offset = len(contents) * 8 + 8
+    table = []
+    
+    for data in contents:
+        table += [offset, len(data)]
+        offset += len(data)
         
-def read_compressed(bbg, offset):
-    # Decompress data
-    bbg.seek(offset)
+    # Write len of files and files info
+    bb.write('BB\x00\x00' + pack('<{}i'.format(len(table) + 1), len(contents), *table))
     
-    header = unpack("<I", bbg.read(4))[0]    
-    compression_type, uncompressed_length = header & 0xFF, header >> 8
+    for data in contents:
+        bb.write(data)
+        
+def same_file(first, second):
+    try:
+        return os.path.sameopenfile(first.fileno(), second.fileno())
+    except (AttributeError, EnvironmentError, ValueError):
+        return first is second
+        
+def copy_file(source, output, size):
+    """Copies the first size bytes of file source to output at its position,
+    a chunk at a time"""
+    source.seek(0)
+    copied = 0
+    while copied < size:
+        chunk = source.read(min(size - copied, 1 << 20))
+        if not chunk:
+            break
+        output.write(chunk)
+        copied += len(chunk)
+        
+def process(job):
+    """Runs one (action, path, entry, image, options) job of the command line
+    tool, in a worker process with -j. The BBG is the file at path, or the
+    (offset, size) entry of the BB there. action is 'extract' to draw it into
+    the PNG image, or 'update' to import image into it, writing the result
+    back to a BBG file. Returns the updated data of BB entries (or None), an
+    error message, so one bad BBG doesn't stop the rest, and the hits and
+    misses of the compression cache during the job."""
+    hits, misses = lzcache.counts()
+    data, error = _process(job)
+    after_hits, after_misses = lzcache.counts()
+    return data, error, after_hits - hits, after_misses - misses
+
+def _process(job):
+    action, path, entry, image, options = job
+    if options['no_cache']:
+        lzcache.disable()
+        
+    try:
+        if entry:
+            offset, size = entry
+            with open(path, 'rb') as bb:
+                bb.seek(offset)
+                bbg = BBG(StringIO(bb.read(size)))
+        else:
+            bbg = BBG(open(path, 'r+b' if action == 'update' else 'rb'))
             
-    if compression_type == 0:
-        # Uncompressed
-        return bbg.read(uncompressed_length)
-    elif compression_type == 0x10:
-        return WiiLZ77(bbg, offset).uncompress()
-    else:
-        raise ValueError
+        try:
+            if action == 'update':
+                if entry:
+                    bbg.update(Image.open(image), **options['update'])
+                    return bbg.bbg.getvalue()[:bbg.header.size], None
+                
+                # Read VRAM offset from the image being replaced
+                bbg.to_image()
+                bbg.update(Image.open(image), **options['update'])
+                return None, None
+                
+            if entry:
+                bbg.to_image().save(image)
+            else:
+                if options['palette']:
+                    with open(options['palette'], 'rb') as bbg_palette:
+                        result = bbg.to_image(bbg_palette)
+                else:
+                    result = bbg.to_image()
+                    
+                # Use wrapper for preserving metadata
+                with open(image, 'wb') as output:
+                    pngsave(result, output)
+        finally:
+            bbg.bbg.close()
+    except Exception as e:
+        return None, '{} while processing {}'.format(e, image if entry else path)
+    return None, None
+
+def run_jobs(jobs, workers=None):
+    """Runs command line jobs, see process(), and yields their results in
+    order. With workers > 1, they run in a pool of that many processes."""
+    if workers is None or workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield process(job)
+        return
+        
+    from multiprocessing import Pool
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        for result in pool.imap(process, jobs):
+            yield result
+    finally:
+        pool.terminate()
         
 def temp_palette():
     palette = []
@@ -410,25 +746,45 @@ if __name__ == '__main__':
     parser.add_argument('files', help='files to work with', type=argparse.FileType('r+b'), nargs="+")
     parser.add_argument('-b', '--bbg', help='only extract bbg images from bb archive', action='store_true')
     parser.add_argument('-p', '--palette', help="external bbg palette", type=argparse.FileType('rb'))
+    parser.add_argument('-s', '--shared-tiles', help='report tiles bbgs in bb archive could share', action='store_true')
     parser.add_argument('-u', '--update', help='update bb file from images', type=argparse.FileType('rb'), nargs="+")
+    parser.add_argument('-l', '--level', help='compression level: 0 - greedy (default), 1 - lazy, 2 - optimal', type=int,
+        choices=(lz77.GREEDY, lz77.LAZY, lz77.OPTIMAL))
+    parser.add_argument('-c', '--codec', help='tile data format, auto picks one by estimated size (default: lz10, '
+        'unchanged tile data is kept as it is stored)', choices=lz77.AUTO_FORMATS + ('auto',))
+    parser.add_argument('--max-chain', help='most candidates each match search looks at, faster but larger '
+        'output, all of them by default', type=int)
+    parser.add_argument('--prefer', help='what auto codec selection optimizes for', choices=('size', 'speed'), default='size')
+    parser.add_argument('--reorder', help='reorder tiles if it makes tile data compress better', action='store_true')
+    parser.add_argument('--patch', help="write updated bbgs into the bb itself if they fit in place of old ones, "
+        "instead of writing all of them to <name>_updated.bb", action='store_true')
+    parser.add_argument('--no-cache', help="don't use the cache of compressed blocks", action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of processes to draw or update bbgs with', type=int)
 
     args = parser.parse_args()
+
+    if args.no_cache:
+        lzcache.disable()
+    
+    options = {
+        'palette': args.palette.name if args.palette else None,
+        'no_cache': args.no_cache,
+        'update': dict(level=args.level, codec=args.codec, prefer=args.prefer, reorder=args.reorder,
+            max_chain=args.max_chain),
+    }
+    
+    jobs = []
+    # BB and number of the entry each job updates, if any
+    targets = []
+    # BBs to save once their entries are updated
+    archives = []
     
     for input_file in args.files:
         if input_file.name.endswith('.bbg'):
             # Single image file
-            bbg = BBG(input_file)
-            
-            try:
-                image = bbg.to_image(args.palette)
-            except Exception as e:
-                print '{} while loading {}'.format(e, input_file.name)
-                raise
-                continue
-            
             if args.update:
-                image = Image.open(args.update[0])
-                bbg.update(image)
+                jobs.append(('update', input_file.name, None, args.update[0].name, options))
+                targets.append((None, None))
                 continue
             
             bbg_name = os.path.splitext(os.path.basename(input_file.name))[0]
@@ -439,16 +795,23 @@ if __name__ == '__main__':
             else:
                 image_name = bbg_name + '.png'
 
-            # Use wrapper for preserving metadata
-            with open(image_name, 'wb') as output:
-                pngsave(image, output)
+            jobs.append(('extract', input_file.name, None, image_name, options))
+            targets.append((None, None))
                 
         elif input_file.name.endswith('.bb'):
             # bb archive
             bb = BB(input_file)
             name = os.path.splitext(os.path.basename(input_file.name))[0]
-            
-            if args.update:            
+
+            if args.shared_tiles:
+                # BBGs can't refer to each other's tiles, so just report
+                for group in bb.shared_tiles():
+                    print '{}: {} tiles, {} distinct, {} bytes shared'.format(
+                        ', '.join('{}_{:03}'.format(name, n + 1) for n in group.entries),
+                        group.tiles_n, group.unique_n, group.saved)
+                continue
+
+            if args.update:
                 update = {}
                 name = os.path.splitext(os.path.basename(input_file.name))[0]
                 
@@ -456,29 +819,53 @@ if __name__ == '__main__':
                     image_name, i = os.path.splitext(os.path.basename(image.name))[0].rsplit('_', 1)
                     
                     if image_name == name:
-                        update[int(i)] = Image.open(image)
+                        update[int(i)] = image.name
                     else:
                         raise ValueError("Wrong image filename: " + image.name)
+                        
+                archives.append((bb, name))
             
-            for n, bbg_data in enumerate(bb.contents):                
+            for n in range(len(bb)):
                 if args.bbg:
                     # Just store bbgs for debug
                     bbg_name = '{}_{:03}.bbg'.format(name, n + 1)
                     with open(bbg_name, 'wb') as output:
-                        output.write(bbg_data)
-                else:                    
-                    # Load image
-                    bbg = BBG(StringIO(bbg_data))
+                        output.write(bb.entries[n])
+                elif args.update:
+                    if n + 1 in update:
+                        # We need to update bbg with new images
+                        jobs.append(('update', input_file.name, bb.entries.table[n], update[n + 1], options))
+                        targets.append((bb, n))
+                else:
+                    image_name = '{}_{:03}.png'.format(name, n + 1)
+                    jobs.append(('extract', input_file.name, bb.entries.table[n], image_name, options))
+                    targets.append((None, None))
                     
-                    if args.update:
-                        if n + 1 in update:
-                            # We need to update bbg with new images
-                            bbg.update(update[n + 1])
-                            bb.contents[n] = bbg.bbg.getvalue()                        
-                    else:
-                        image = bbg.to_image()
-                        image_name = '{}_{:03}.png'.format(name, n + 1)
-                        image.save(image_name)
+    # Results come in the order of jobs, whatever order they finish in
+    failed = 0
+    # Workers count their own cache hits, so they are added up here
+    hits = misses = 0
+    for (bb, n), (data, error, job_hits, job_misses) in izip(targets, run_jobs(jobs, args.jobs)):
+        hits += job_hits
+        misses += job_misses
+        if error:
+            print error
+            failed += 1
+        elif bb is not None:
+            bb[n] = data
             
-            if args.update:                
-                bb.save(open('{}_updated.bb'.format(name), 'w'))
\ No newline at end of file
+    for bb, name in archives:
+        if args.patch and bb.fits():
+            # Only the changed BBGs and their table entries are written
+            bb.patch(bb.entries.file)
+            print '{}.bb patched in place'.format(name)
+            continue
+        with open('{}_updated.bb'.format(name), 'wb') as output:
+            bb.save(output)
+
+    if hits or misses:
+        print 'Compression cache: {} hits, {} misses'.format(hits, misses)
+        
+    if failed:
+        print '{} of {} failed'.format(failed, len(jobs))
+        sys.exit(1)
\ No newline at end of file
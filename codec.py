@@ -0,0 +1,400 @@
+# Decoders for the compressed blocks of Nintendo DS files, selected by the
+# type byte of the block's header
+from functools import partial
+from struct import unpack
+from wii_lz77 import max_compressed_size, uncompress_lz10
+
+class UnknownCompressionError(ValueError):
+    """Raised for a block with a compression type no decoder is registered
+    for"""
+    def __init__(self, compression_type, offset=None):
+        self.compression_type = compression_type
+        self.offset = offset
+        message = 'Unknown compression type 0x{:02x}'.format(compression_type)
+        if offset is not None:
+            message += ' at 0x{:x}'.format(offset)
+        ValueError.__init__(self, message)
+
+def uncompress_raw(data, uncompressed_length, start=0):
+    out = bytes(bytearray(data[start:start + uncompressed_length]))
+    if len(out) < uncompressed_length:
+        raise ValueError("Data ends after {} of {} bytes".format(len(out), uncompressed_length))
+    return out
+
+def uncompress_lz11(data, uncompressed_length, start=0):
+    """Decodes an LZ11 body starting at start of data into
+    uncompressed_length bytes"""
+    src = bytearray(data)
+    out = bytearray(uncompressed_length)
+    src_len = len(src)
+    i = start
+    o = 0
+
+    try:
+        while o < uncompressed_length:
+            if i >= src_len:
+                raise ValueError("Compressed data ends after {} of {} bytes".format(o, uncompressed_length))
+            flags = src[i]
+            i += 1
+
+            for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if flags & bit:
+                    first = src[i]
+                    indicator = first >> 4
+                    if indicator == 0:
+                        # 3 bytes, 0x11 to 0x110 bytes long
+                        num = ((first << 4) | (src[i + 1] >> 4)) + 0x11
+                        disp = (((src[i + 1] & 0xF) << 8) | src[i + 2]) + 1
+                        i += 3
+                    elif indicator == 1:
+                        # 4 bytes, 0x111 to 0x10110 bytes long
+                        num = (((first & 0xF) << 12) | (src[i + 1] << 4) | (src[i + 2] >> 4)) + 0x111
+                        disp = (((src[i + 2] & 0xF) << 8) | src[i + 3]) + 1
+                        i += 4
+                    else:
+                        # 2 bytes, 3 to 0x10 bytes long
+                        num = indicator + 1
+                        disp = (((first & 0xF) << 8) | src[i + 1]) + 1
+                        i += 2
+
+                    num = min(num, uncompressed_length - o)
+                    ptr = o - disp
+                    if ptr < 0:
+                        raise ValueError("Back reference before the start of data at {}".format(o))
+
+                    if disp >= num:
+                        out[o:o + num] = out[ptr:ptr + num]
+                    else:
+                        out[o:o + num] = (out[ptr:o] * (num // disp + 1))[:num]
+                    o += num
+                else:
+                    out[o] = src[i]
+                    i += 1
+                    o += 1
+
+                if o >= uncompressed_length:
+                    break
+    except IndexError:
+        # A token is cut short
+        raise ValueError("Compressed data ends after {} of {} bytes".format(o, uncompressed_length))
+
+    return bytes(out)
+
+def uncompress_rle(data, uncompressed_length, start=0):
+    """Decodes a run-length encoded body starting at start of data into
+    uncompressed_length bytes"""
+    src = bytearray(data)
+    out = bytearray(uncompressed_length)
+    i = start
+    o = 0
+
+    try:
+        while o < uncompressed_length:
+            flag = src[i]
+            i += 1
+            if flag & 0x80:
+                # A run of one byte
+                num = min((flag & 0x7F) + 3, uncompressed_length - o)
+                out[o:o + num] = bytearray((src[i],)) * num
+                i += 1
+            else:
+                num = min((flag & 0x7F) + 1, uncompressed_length - o)
+                out[o:o + num] = src[i:i + num]
+                if len(src) < i + num:
+                    raise ValueError("Compressed data ends after {} of {} bytes".format(o, uncompressed_length))
+                i += (flag & 0x7F) + 1
+            o += num
+    except IndexError:
+        # A token is cut short
+        raise ValueError("Compressed data ends after {} of {} bytes".format(o, uncompressed_length))
+
+    return bytes(out)
+
+def uncompress_huffman(data, uncompressed_length, start=0, bits=8):
+    """Decodes a Huffman body starting at start of data into
+    uncompressed_length bytes of bits wide (4 or 8) symbols.
+
+    The bitstream is walked a byte at a time: the symbols a byte yields from
+    a given tree node and the node it ends at are computed once and reused."""
+    src = bytearray(data)
+    tree = start
+    root = tree + 1
+    i = tree + (src[tree] + 1) * 2
+    symbols_n = uncompressed_length * 8 // bits
+
+    transitions = {}
+
+    def walk(node, byte):
+        symbols = []
+        for shift in range(7, -1, -1):
+            bit = (byte >> shift) & 1
+            value = src[node]
+            child = tree + (((node - tree) & ~1) + (value & 0x3F) * 2 + 2) + bit
+            if value & (0x80 >> bit):
+                symbols.append(src[child])
+                node = root
+            else:
+                node = child
+        return symbols, node
+
+    symbols = []
+    node = root
+    while len(symbols) < symbols_n:
+        if len(src) < i + 4:
+            raise ValueError("Compressed data ends after {} of {} symbols".format(len(symbols), symbols_n))
+        # 32-bit little endian units, most significant bit first
+        for byte in (src[i + 3], src[i + 2], src[i + 1], src[i]):
+            key = (node << 8) | byte
+            try:
+                found, node = transitions[key]
+            except KeyError:
+                found, node = transitions[key] = walk(node, byte)
+            symbols.extend(found)
+        i += 4
+    del symbols[symbols_n:]
+
+    if bits == 8:
+        return bytes(bytearray(symbols))
+
+    # Two 4-bit symbols per byte, low nibble first
+    return bytes(bytearray((low & 0xF) | ((high & 0xF) << 4) for low, high in zip(symbols[::2], symbols[1::2])))
+
+def _rle_span(uncompressed_length):
+    return uncompressed_length + (uncompressed_length + 127) // 128
+
+# compression type: (decoder, longest compressed body for an uncompressed
+# length, or None if unknown)
+DECODERS = {
+    0x00: (uncompress_raw, lambda length: length),
+    0x10: (uncompress_lz10, max_compressed_size),
+    0x11: (uncompress_lz11, max_compressed_size),
+    0x24: (partial(uncompress_huffman, bits=4), None),
+    0x28: (partial(uncompress_huffman, bits=8), None),
+    0x30: (uncompress_rle, _rle_span),
+}
+
+def register(compression_type, decoder, span=None):
+    """Registers decoder(data, uncompressed_length, start) for blocks of
+    compression_type. span(uncompressed_length) returns the longest possible
+    compressed body, None means a block may take the rest of its file."""
+    DECODERS[compression_type] = (decoder, span)
+
+def parse_header(header):
+    """Returns (compression type, uncompressed length) of a block header"""
+    header = unpack("<I", header)[0]
+    return header & 0xFF, header >> 8
+
+def _decoder(compression_type, offset):
+    try:
+        return DECODERS[compression_type]
+    except KeyError:
+        raise UnknownCompressionError(compression_type, offset)
+
+def _block(data, offset):
+    """Returns (compression type, uncompressed length, body) of the block at
+    offset of data, body being a slice of data no longer than the block can
+    be"""
+    compression_type, uncompressed_length = parse_header(bytes(data[offset:offset + 4]))
+    decoder, span = _decoder(compression_type, offset)
+
+    if span is None:
+        body = data[offset + 4:]
+    else:
+        body = data[offset + 4:offset + 4 + span(uncompressed_length)]
+    return compression_type, uncompressed_length, body
+
+def _decompress_block(block):
+    compression_type, uncompressed_length, body = block
+    return DECODERS[compression_type][0](body, uncompressed_length)
+
+def decompress(data, offset=0):
+    """Decodes the block, header included, at offset of data (a byte string,
+    buffer, memoryview or mmap)"""
+    return _decompress_block(_block(data, offset))
+
+def decompress_many(data, offsets, workers=None):
+    """Decodes the blocks at offsets of data (see decompress()) and returns a
+    dict of offset to decoded bytes. Each offset is decoded once however many
+    times it's listed.
+
+    With workers > 1, the blocks are decoded in a pool of that many worker
+    processes, which are sent only the compressed bytes of each block."""
+    offsets = sorted(set(offsets))
+
+    if workers is None or workers <= 1 or len(offsets) <= 1:
+        return dict((offset, decompress(data, offset)) for offset in offsets)
+
+    jobs = []
+    for offset in offsets:
+        compression_type, uncompressed_length, body = _block(data, offset)
+        jobs.append((compression_type, uncompressed_length, bytes(body)))
+
+    from multiprocessing import Pool
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        results = pool.map(_decompress_block, jobs)
+    finally:
+        pool.terminate()
+    return dict(zip(offsets, results))
+
+def map_file(f):
+    """Returns the contents of file f as a read-only mmap, or as a byte string
+    for files that can't be mapped (e.g. StringIO or empty files)"""
+    import mmap
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        f.seek(0)
+        return f.read()
+
+def read_compressed(f, offset):
+    """Reads and decodes the block at offset of file f"""
+    f.seek(offset)
+    compression_type, uncompressed_length = parse_header(f.read(4))
+    decoder, span = _decoder(compression_type, offset)
+
+    if span is None:
+        data = f.read()
+    else:
+        data = f.read(span(uncompressed_length))
+    return decoder(data, uncompressed_length)
+
+# How far back an LZ10/LZ11 reference can reach
+WINDOW_SIZE = 0x1000
+
+class _Reader(object):
+    """Reads a file or buffer from offset on in blocks, so only one block is
+    held at a time"""
+    def __init__(self, source, offset, block_size=0x1000):
+        self.source = source
+        self.position = offset
+        self.block_size = block_size
+        self.block = bytearray()
+        self.index = 0
+
+        if hasattr(source, 'read'):
+            source.seek(offset)
+
+    def fill(self):
+        if hasattr(self.source, 'read'):
+            block = self.source.read(self.block_size)
+        else:
+            block = self.source[self.position:self.position + self.block_size]
+        if not len(block):
+            raise ValueError("Compressed data ends at 0x{:x}".format(self.position))
+        self.position += len(block)
+        self.block = bytearray(block)
+        self.index = 0
+
+    def byte(self):
+        if self.index >= len(self.block):
+            self.fill()
+        value = self.block[self.index]
+        self.index += 1
+        return value
+
+    def read(self, n):
+        data = bytearray()
+        while len(data) < n:
+            if self.index >= len(self.block):
+                self.fill()
+            piece = self.block[self.index:self.index + n - len(data)]
+            self.index += len(piece)
+            data += piece
+        return data
+
+def iter_decompress(source, offset=0, chunk_size=0x1000):
+    """Generates the decoded contents of the raw, LZ10 or LZ11 block at offset
+    of source (a file or a buffer) in chunks of chunk_size bytes, the last
+    one possibly shorter.
+
+    Compressed data is read as it's needed and only the reference window and
+    the current chunk are kept, so stopping early costs only what was
+    decoded."""
+    reader = _Reader(source, offset)
+    compression_type, uncompressed_length = parse_header(bytes(reader.read(4)))
+
+    if compression_type == 0x00:
+        remaining = uncompressed_length
+        while remaining:
+            chunk = reader.read(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            yield bytes(chunk)
+        return
+    elif compression_type not in (0x10, 0x11):
+        raise UnknownCompressionError(compression_type, offset)
+    lz11 = compression_type == 0x11
+
+    # The window followed by the current chunk, which starts at start
+    out = bytearray()
+    start = 0
+    total = 0
+
+    while total < uncompressed_length:
+        flags = reader.byte()
+
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if flags & bit:
+                first = reader.byte()
+                second = reader.byte()
+                if not lz11:
+                    num = 3 + (first >> 4)
+                    disp = (((first & 0xF) << 8) | second) + 1
+                elif first >> 4 == 0:
+                    third = reader.byte()
+                    num = ((first << 4) | (second >> 4)) + 0x11
+                    disp = (((second & 0xF) << 8) | third) + 1
+                elif first >> 4 == 1:
+                    third = reader.byte()
+                    fourth = reader.byte()
+                    num = (((first & 0xF) << 12) | (second << 4) | (third >> 4)) + 0x111
+                    disp = (((third & 0xF) << 8) | fourth) + 1
+                else:
+                    num = (first >> 4) + 1
+                    disp = (((first & 0xF) << 8) | second) + 1
+
+                num = min(num, uncompressed_length - total)
+                ptr = len(out) - disp
+                if ptr < 0:
+                    raise ValueError("Back reference before the start of data at {}".format(total))
+
+                if disp >= num:
+                    out += out[ptr:ptr + num]
+                else:
+                    out += (out[ptr:] * (num // disp + 1))[:num]
+                total += num
+            else:
+                out.append(reader.byte())
+                total += 1
+
+            if total >= uncompressed_length:
+                break
+
+        if len(out) - start >= chunk_size:
+            while len(out) - start >= chunk_size:
+                yield bytes(out[start:start + chunk_size])
+                start += chunk_size
+
+            # Keep only what references can still reach
+            if start > WINDOW_SIZE:
+                del out[:start - WINDOW_SIZE]
+                start = WINDOW_SIZE
+
+    if start < len(out):
+        yield bytes(out[start:])
+
+def decode(source, offset=0, limit=None):
+    """Returns the decoded contents of the block at offset of source (a file
+    or a buffer), or only their first limit bytes, in which case decoding
+    stops as soon as they're available"""
+    if limit is None:
+        return b''.join(iter_decompress(source, offset))
+
+    out = []
+    length = 0
+    for chunk in iter_decompress(source, offset, max(1, min(limit, 0x1000))):
+        out.append(chunk)
+        length += len(chunk)
+        if length >= limit:
+            break
+    return b''.join(out)[:limit]
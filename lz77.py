@@ -2,12 +2,27 @@
 
 # used http://code.google.com/p/u-lzss/source/browse/trunk/js/lib/ulzss.js as
 # a guide
+from __future__ import print_function
+
+import os
+import re
+import stat
+import tempfile
+import time
 from sys import stderr
 
-from collections import defaultdict
-from operator import itemgetter
 from struct import pack, unpack
 
+import lzcache
+
+# Compression levels, i.e. the way the input is split into tokens
+GREEDY = 0  # always take the longest match
+LAZY = 1  # defer a match if the next position has a longer one
+OPTIMAL = 2  # minimize the total size of the tokens
+
+# A run of a single byte
+RUN = re.compile(br'(.)\1*', re.DOTALL)
+
 class SlidingWindow:
     # The size of the sliding window
     size = 4096
@@ -19,88 +34,231 @@ class SlidingWindow:
     # compressed stream.
     disp_start = 1
 
-    # The minimum length for a successful match in the window
-    match_min = 1
+    # The minimum length for a successful match in the window. Positions are
+    # indexed by their first three bytes, so this can't be less than 3.
+    match_min = 3
 
     # The maximum length of a successful match, inclusive.
     match_max = None
 
-    def __init__(self, buf):
+    # The maximum number of candidates examined by a single search. None
+    # walks the whole chain, which always finds the longest match.
+    max_chain = None
+
+    # Lengths at which the token cost changes, see match_cost()
+    cost_steps = ()
+
+    def __init__(self, buf, max_chain=None):
         self.data = buf
-        self.hash = defaultdict(list)
-        self.full = False
+        if max_chain is not None:
+            if max_chain < 1:
+                raise ValueError("max_chain must be at least 1, not %r" % (max_chain,))
+            self.max_chain = max_chain
+
+        # Most recent position for every 3-byte prefix seen so far
+        self.head = {}
+        # Previous position with the same prefix, as a ring buffer indexed by
+        # position modulo the window size. Slots are overwritten as the window
+        # moves on, so nothing has to be evicted explicitly.
+        self.chain = [-1] * self.size
+        # First position of the run of a single repeated byte each position
+        # with such a prefix is in, indexed like chain
+        self.run_starts = [0] * self.size
+        # Start and end of the last run searched from
+        self.run = (-1, -1)
 
-        self.start = 0
-        self.stop = 0
-        #self.index = self.disp_min - 1
         self.index = 0
 
         assert self.match_max is not None
+        assert self.match_min >= 3
+
+    # Cost of a literal in the compressed stream, in bits, including its bit
+    # in the flag byte
+    literal_cost = 9
+
+    def match_cost(self, count):
+        """Returns the cost of a match token of the given length in bits,
+        including its bit in the flag byte."""
+        return 17
 
     def next(self):
-        if self.index < self.disp_start - 1:
-            self.index += 1
-            return
-
-        if self.full:
-            olditem = self.data[self.start]
-            assert self.hash[olditem][0] == self.start
-            self.hash[olditem].pop(0)
-
-        item = self.data[self.stop]
-        self.hash[item].append(self.stop)
-        self.stop += 1
-        self.index += 1
-
-        if self.full:
-            self.start += 1
-        else:
-            if self.size <= self.stop:
-                self.full = True
+        self.advance(1)
 
     def advance(self, n=1):
         """Advance the window by n bytes"""
-        for _ in range(n):
-            self.next()
+        data = self.data
+        head = self.head
+        chain = self.chain
+        size = self.size
+
+        run_starts = self.run_starts
+        run_start = run_starts[(self.index - 1) % size]
+        stop = min(self.index + n, len(data) - 2)
+        for pos in range(self.index, stop):
+            key = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+            previous = head.get(key, -1)
+            chain[pos % size] = previous
+            # Only a run of one byte has the same prefix at consecutive
+            # positions
+            if previous != pos - 1:
+                run_start = pos
+            run_starts[pos % size] = run_start
+            head[key] = pos
+
+        self.index += n
 
     def search(self):
-        match_max = self.match_max
-        match_min = self.match_min
-
-        counts = []
-        indices = self.hash[self.data[self.index]]
-        for i in indices:
-            matchlen = self.match(i, self.index)
-            if matchlen >= match_min:
-                disp = self.index - i
-                #assert self.index - disp >= 0
-                #assert self.disp_min <= disp < self.size + self.disp_min
-                if self.disp_min <= disp:
-                    counts.append((matchlen, -disp))
-                    if matchlen >= match_max:
-                        #assert matchlen == match_max
-                        return counts[-1]
-
-        if counts:
-            match = max(counts, key=itemgetter(0))
-            return match
+        data = self.data
+        index = self.index
+        limit = min(len(data) - index, self.match_max)
+        if limit < self.match_min:
+            return None
+
+        key = (data[index] << 16) | (data[index + 1] << 8) | data[index + 2]
+        candidate = self.head.get(key, -1)
+        lowest = max(index - self.size, 0)
+        chain = self.chain
+        size = self.size
+        disp_min = self.disp_min
+        depth = self.max_chain
+
+        if data[index] == data[index + 1] == data[index + 2]:
+            return self._search_run(candidate, lowest, limit)
+
+        best = 0
+        best_disp = 0
+        while candidate >= lowest:
+            disp = index - candidate
+            if disp_min <= disp:
+                # Only a candidate that also matches the byte just past the
+                # current best can improve on it
+                if data[candidate + best] == data[index + best]:
+                    matchlen = self.match(candidate, index)
+                    if matchlen > best:
+                        best = matchlen
+                        best_disp = disp
+                        if matchlen >= limit:
+                            break
+                if depth is not None:
+                    depth -= 1
+                    if not depth:
+                        break
+            candidate = chain[candidate % size]
+
+        if best >= self.match_min:
+            return best, -best_disp
 
         return None
 
-    def match(self, start, bufstart):
-        size = self.index - start
+    def _search_run(self, candidate, lowest, limit):
+        """search() for a position starting with three times the same byte.
+
+        Every candidate is then in a run of that byte, and how long it matches
+        only depends on where its run ends: positions further back in a run
+        match longer up to the length of the run at the current position, and
+        past that exactly as long. So only one candidate per run is compared,
+        the same one a walk through the whole chain would pick."""
+        data = self.data
+        index = self.index
+        chain = self.chain
+        run_starts = self.run_starts
+        size = self.size
+        disp_min = self.disp_min
+        depth = self.max_chain
+
+        start = run_starts[candidate % size] if candidate == index - 1 else index
+        if self.run[0] != start:
+            self.run = start, RUN.match(data, index).end()
+        run = min(self.run[1] - index, limit)
+
+        best = 0
+        best_disp = 0
+        if candidate == index - 1:
+            # The run continues from before index, and each of its positions
+            # matches exactly as far as the run goes from index
+            if index - disp_min >= max(start, lowest):
+                best = run
+                best_disp = disp_min
+                if best >= limit:
+                    return best, -best_disp
+                if depth is not None:
+                    depth -= 1
+            candidate = chain[start % size] if start >= lowest else -1
+
+        while candidate >= lowest and depth != 0:
+            # The chain enters each earlier run at its last position, and the
+            # run ends with the byte 3 further on
+            start = run_starts[candidate % size]
+            end = candidate + 3
+            nearest = end - run
+            if nearest < start or nearest < lowest:
+                nearest = start if start > lowest else lowest
+                matchlen = end - nearest
+            elif best < run or data[nearest + best] == data[index + best]:
+                # A run as long as the one at index can match further
+                matchlen = self.match(nearest, index)
+            else:
+                matchlen = 0
+            if matchlen > best:
+                best = matchlen
+                best_disp = index - nearest
+                if matchlen >= limit:
+                    break
+            if depth is not None:
+                depth -= 1
+            if start < lowest:
+                break
+            candidate = chain[start % size]
+
+        if best >= self.match_min:
+            return best, -best_disp
+
+        return None
 
-        if size == 0:
+    def match(self, start, bufstart):
+        """Returns the length of the match of the data at bufstart against the
+        data at start.
+
+        When the match overlaps its own beginning (a displacement shorter
+        than the match), the source bytes are the first bufstart - start
+        bytes repeated, which are the same bytes that are already in the
+        buffer at start onwards. So whole slices of the buffer can be compared
+        in both cases: the match is extended by chunks of growing size and the
+        first mismatch is then found by bisecting the last chunk, which makes
+        even very long runs cost only a few slice comparisons."""
+        if start == bufstart:
             return 0
 
+        data = self.data
+        limit = min(len(data) - bufstart, self.match_max)
+
+        # Most matches are short, and those are quicker to check byte by byte
         matchlen = 0
-        it = range(min(len(self.data) - bufstart, self.match_max))
-        for i in it:
-            if self.data[start + (i % size)] == self.data[bufstart + i]:
-                matchlen += 1
-            else:
+        head = min(limit, 8)
+        while matchlen < head:
+            if data[start + matchlen] != data[bufstart + matchlen]:
+                return matchlen
+            matchlen += 1
+
+        step = 16
+        while matchlen < limit:
+            step = min(step, limit - matchlen)
+            if data[start + matchlen:start + matchlen + step] != data[bufstart + matchlen:bufstart + matchlen + step]:
                 break
-        return matchlen
+            matchlen += step
+            step *= 2
+        else:
+            return matchlen
+
+        # The first mismatch is somewhere in [low, high)
+        low, high = matchlen, matchlen + step
+        while high - low > 1:
+            middle = (low + high) // 2
+            if data[start + low:start + middle] == data[bufstart + low:bufstart + middle]:
+                low = middle
+            else:
+                high = middle
+        return low
 
 class NLZ10Window(SlidingWindow):
     size = 4096
@@ -114,15 +272,74 @@ class NLZ11Window(SlidingWindow):
     match_min = 3
     match_max = 0x111 + 0xFFFF
 
+    # The longest match of each token size except the last one
+    cost_steps = (0x10, 0x110)
+
+    def match_cost(self, count):
+        if count <= 0x10:
+            return 17
+        elif count <= 0x110:
+            return 25
+        return 33
+
 class NOverlayWindow(NLZ10Window):
     disp_min = 3
 
-def _compress(input, windowclass=NLZ10Window):
-    """Generates a stream of tokens. Either a byte (int) or a tuple of (count,
-    displacement)."""
-
-    window = windowclass(input)
+def _tobytes(input):
+    """Returns input as a bytearray. Accepts byte strings, buffers, and lists
+    of either single characters or ints."""
+    if isinstance(input, bytearray):
+        return input
+    if isinstance(input, list) and input and not isinstance(input[0], int):
+        input = b''.join(input)
+    return bytearray(input)
 
+def _compress(input, windowclass=NLZ10Window, level=GREEDY, max_chain=None, workers=None):
+    """Generates a stream of tokens. Either a byte (int) or a tuple of (count,
+    displacement).
+
+    With workers > 1, inputs longer than SEGMENT_MIN have their matches found
+    in that many processes, see _find_matches_parallel().
+
+    OPTIMAL searches every position, with at most OPTIMAL_MAX_CHAIN candidates
+    each unless max_chain is given. The matches the greedy parse takes with
+    max_chain are added to those, so the result is never larger than
+    GREEDY's."""
+
+    input = _tobytes(input)
+    depth = max_chain
+    if level == OPTIMAL and depth is None:
+        depth = OPTIMAL_MAX_CHAIN
+    window = windowclass(input, depth)
+
+    if level == GREEDY:
+        parse = _parse_greedy
+    elif level == LAZY:
+        parse = _parse_lazy
+    elif level == OPTIMAL:
+        parse = _parse_optimal
+    else:
+        raise ValueError("Unknown compression level %r" % (level,))
+
+    if workers is not None and workers > 1 and SEGMENT_MIN < len(input):
+        matches = _find_matches_parallel(input, windowclass, depth, workers)
+    elif level == OPTIMAL:
+        matches = _find_matches(window, len(input))
+    else:
+        matches = None
+
+    if level == OPTIMAL:
+        _add_greedy_matches(input, windowclass, max_chain, matches)
+
+    if matches is not None:
+        tokens = _parse_matches(input, window, matches, level)
+    else:
+        tokens = parse(input, window)
+
+    for t in tokens:
+        yield t
+
+def _parse_greedy(input, window):
     i = 0
     while True:
         if len(input) <= i:
@@ -139,106 +356,423 @@ def _compress(input, windowclass=NLZ10Window):
             window.next()
             i += 1
 
-def packflags(flags):
-    n = 0
-    for i in range(8):
-        n <<= 1
-        try:
-            if flags[i]:
-                n |= 1
-        except IndexError:
-            pass
-    return n
-
-def chunkit(it, n):
-    buf = []
-    for x in it:
-        buf.append(x)
-        if n <= len(buf):
-            yield buf
-            buf = []
-    if buf:
-        yield buf
-
-def compress(input, out):
-    # header
-    out.write(pack("<L", (len(input) << 8) + 0x10))
+def _parse_lazy(input, window):
+    """Like _parse_greedy, but emits a literal instead of a match if the match
+    starting at the next byte is longer."""
+    i = 0
+    match = window.search()
+    while i < len(input):
+        if match:
+            window.next()
+            if match[0] < window.match_max:
+                following = window.search()
+                if following and following[0] > match[0]:
+                    yield input[i]
+                    i += 1
+                    match = following
+                    continue
+            yield match
+            window.advance(match[0] - 1)
+            i += match[0]
+        else:
+            yield input[i]
+            window.next()
+            i += 1
+        match = window.search()
 
-    # body
-    length = 0
-    for tokens in chunkit(_compress(input), 8):
-        flags = [type(t) == tuple for t in tokens]
-        out.write(pack(">B", packflags(flags)))
+def _find_matches(window, n):
+    """Returns the longest match for each of the n positions of the window
+    as a list of (count, displacement) tuples or None. Every position is
+    searched, so each match is the one a sequential parse would find there."""
+    matches = []
+    for i in range(n):
+        matches.append(window.search())
+        window.next()
+    return matches
+
+def _add_greedy_matches(input, windowclass, max_chain, matches):
+    """Puts the matches the greedy parse takes into matches where they are
+    longer than the ones found, so the optimal parse can always do as well."""
+    i = 0
+    for t in _parse_greedy(input, windowclass(input, max_chain)):
+        if type(t) == tuple:
+            if not matches[i] or matches[i][0] < t[0]:
+                matches[i] = t
+            i += t[0]
+        else:
+            i += 1
 
-        for t in tokens:
-            if type(t) == tuple:
-                count, disp = t
+# Candidates each search of OPTIMAL looks at when no max_chain is given.
+# Searching every position through the whole chain can take most of a minute
+# for 64 KiB of repetitive data, and the greedy matches added to the ones
+# found make up for most of what a shallower search misses.
+OPTIMAL_MAX_CHAIN = 64
+
+# Ranges of lengths with the same token cost at least this long are looked up
+# in a segment tree by _parse_optimal() rather than tried one by one
+WIDE_RANGE = 32
+
+def _parse_optimal(input, window, matches=None):
+    """Picks the cheapest sequence of tokens by the window's cost model with
+    dynamic programming over every length of the longest match at every
+    position."""
+    n = len(input)
+    if matches is None:
+        matches = _find_matches(window, n)
+
+    literal_cost = window.literal_cost
+    match_cost = window.match_cost
+
+    # Lengths with the same token cost, as (shortest, longest, cost)
+    ranges = []
+    shortest = window.match_min
+    for longest in window.cost_steps + (window.match_max,):
+        ranges.append((shortest, longest, match_cost(shortest)))
+        shortest = longest + 1
+
+    # cost[i] is the cheapest encoding of input[i:], choice[i] is the length
+    # of the token it starts with (0 for a literal)
+    cost = [0] * (n + 1)
+    choice = [0] * n
+
+    # Wide ranges take the minimum of cost[i + count] from a segment tree of
+    # cost[j] * stride + j over the positions done so far, which also gives
+    # the shortest count on ties like the narrow ones
+    stride = n + 1
+    tree = None
+    if any(longest - shortest >= WIDE_RANGE for shortest, longest, _ in ranges):
+        leaves = 1
+        while leaves < stride:
+            leaves *= 2
+        inf = float('inf')
+        tree = [inf] * (2 * leaves)
+        # cost[n] is 0
+        node = leaves + n
+        while node:
+            tree[node] = n
+            node >>= 1
+
+    for i in range(n - 1, -1, -1):
+        best = literal_cost + cost[i + 1]
+        best_count = 0
+        match = matches[i]
+        if match:
+            longest = match[0]
+            for low, high, token in ranges:
+                if longest < low:
+                    break
+                high = min(high, longest)
+                if high - low < WIDE_RANGE or tree is None:
+                    for count in range(low, high + 1):
+                        c = token + cost[i + count]
+                        if c < best:
+                            best = c
+                            best_count = count
+                    continue
+
+                lo = leaves + i + low
+                hi = leaves + i + high + 1
+                key = inf
+                while lo < hi:
+                    if lo & 1:
+                        if tree[lo] < key:
+                            key = tree[lo]
+                        lo += 1
+                    if hi & 1:
+                        hi -= 1
+                        if tree[hi] < key:
+                            key = tree[hi]
+                    lo >>= 1
+                    hi >>= 1
+                c = token + key // stride
+                if c < best:
+                    best = c
+                    best_count = key % stride - i
+        cost[i] = best
+        choice[i] = best_count
+
+        if tree is not None:
+            # Keys are only ever lowered, so the update can stop at the
+            # first node whose minimum doesn't change
+            key = best * stride + i
+            node = leaves + i
+            tree[node] = key
+            node >>= 1
+            while node and key < tree[node]:
+                tree[node] = key
+                node >>= 1
+
+    i = 0
+    while i < n:
+        count = choice[i]
+        if count:
+            yield count, matches[i][1]
+            i += count
+        else:
+            yield input[i]
+            i += 1
+
+def _parse_matches(input, window, matches, level):
+    """Parses input like _compress() does for the given level, but from the
+    longest match at every position instead of searching the window."""
+    if level == OPTIMAL:
+        for t in _parse_optimal(input, window, matches):
+            yield t
+        return
+
+    i = 0
+    while i < len(input):
+        match = matches[i]
+        if match and level == LAZY and i + 1 < len(input):
+            following = matches[i + 1]
+            if following and following[0] > match[0]:
+                match = None
+        if match:
+            yield match
+            i += match[0]
+        else:
+            yield input[i]
+            i += 1
+
+# Inputs are split into segments of at least this many bytes for parallel
+# match finding
+SEGMENT_MIN = 0x8000
+
+def _segment_matches(job):
+    """Finds the longest matches for count positions of data following the
+    first prime bytes, which only fill the window."""
+    windowclass, max_chain, data, prime, count = job
+    window = windowclass(bytearray(data), max_chain)
+    window.advance(prime)
+    return _find_matches(window, count)
+
+def _find_matches_parallel(input, windowclass, max_chain, workers):
+    """Like _find_matches(), but splits input into segments that are searched
+    in a pool of worker processes.
+
+    Each segment is sent along with the window's worth of bytes before it,
+    so its matches can reach back as far as in a single pass, and the bytes
+    after it that a match could extend into. Every position is searched with
+    the same window contents as in a single pass, so the joined list holds
+    the same matches, and the tokens chosen from it in one sequential pass
+    are the same as without workers at every level."""
+    length = len(input)
+    segment = max(SEGMENT_MIN, -(-length // workers))
+
+    jobs = []
+    for start in range(0, length, segment):
+        count = min(segment, length - start)
+        prime = min(start, windowclass.size)
+        stop = min(length, start + count + windowclass.match_max)
+        jobs.append((windowclass, max_chain, input[start - prime:stop], prime, count))
+
+    matches = []
+    for segment_matches in _pool_map(_segment_matches, jobs, min(workers, len(jobs))):
+        matches.extend(segment_matches)
+    return matches
+
+def _pool_map(function, jobs, workers=None):
+    """Yields the results of function for each of jobs, run in a pool of
+    workers processes (as many as cores for None), in the order of jobs.
+    concurrent.futures is used where there is one, Python 2 falls back to
+    multiprocessing."""
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        from multiprocessing import Pool
+        pool = Pool(workers)
+        try:
+            for result in pool.imap(function, jobs):
+                yield result
+        finally:
+            pool.terminate()
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        for result in pool.map(function, jobs):
+            yield result
+
+# Container type and window class of each format
+FORMATS = {
+    'raw': (0x00, None),
+    'lz10': (0x10, NLZ10Window),
+    'lz11': (0x11, NLZ11Window),
+}
+
+# Formats from the fastest to the slowest to decode
+DECODE_ORDER = ('raw', 'lz10', 'lz11')
+
+# Formats compress_auto() chooses from by default
+AUTO_FORMATS = DECODE_ORDER
+
+# With prefer='speed', a format that is faster to decode is taken as long as
+# its estimated size is within this fraction of the smallest one
+SPEED_SLACK = 0.125
+
+def _padding(length):
+    return 4 - (length % 4 or 4)
+
+def compress_bytes(input, fmt='lz10', level=GREEDY, workers=None, max_chain=None):
+    """Compresses input into a raw, LZ10 or LZ11 stream and returns it as
+    bytes, header and padding included. workers > 1 finds matches of large
+    inputs in that many processes. max_chain limits the candidates each match
+    search looks at, trading size for speed; None looks at all of them.
+
+    Compressed streams are looked up in and added to the lzcache cache."""
+    try:
+        compression_type, windowclass = FORMATS[fmt]
+    except KeyError:
+        raise ValueError("Unknown compression format %r" % (fmt,))
+
+    input = _tobytes(input)
+
+    if windowclass is None:
+        return pack("<L", len(input) << 8) + bytes(input) + b'\xff' * _padding(len(input))
+
+    cache = lzcache.default()
+    if cache:
+        key = cache.key(input, fmt, windowclass, level, max_chain)
+        out = cache.get(key)
+        if out is not None:
+            return out
+
+    out = _encode(input, compression_type, windowclass, level, workers, max_chain)
+
+    if cache:
+        cache.put(key, out)
+    return out
+
+def _encode(input, compression_type, windowclass, level, workers, max_chain):
+    lz11 = compression_type == 0x11
+    length = len(input)
+
+    # Any match is shorter than the literals it replaces, so the output can't
+    # be longer than a header, all bytes as literals with their flag bytes,
+    # and padding
+    out = bytearray(4 + length + (length + 7) // 8 + 3)
+    out[0:4] = pack("<L", (length << 8) + compression_type)
+
+    i = 4
+    flags = 0
+    flag = 0
+    for t in _compress(input, windowclass=windowclass, level=level, max_chain=max_chain, workers=workers):
+        if not flag:
+            # Start a new block of 8 tokens, its flag byte is filled in as
+            # matches come
+            flags = i
+            i += 1
+            flag = 0x80
+
+        if type(t) == tuple:
+            out[flags] |= flag
+            count, disp = t
+            disp = (-disp) - 1
+            assert 0 <= disp <= 0xFFF
+            if not lz11:
                 count -= 3
-                disp = (-disp) - 1
-                assert 0 <= disp < 4096
-                sh = (count << 12) | disp
-                out.write(pack(">H", sh))
+                out[i] = (count << 4) | (disp >> 8)
+                out[i + 1] = disp & 0xFF
+                i += 2
+            elif count <= 1 + 0xF:
+                count -= 1
+                assert 2 <= count <= 0xF
+                out[i] = (count << 4) | (disp >> 8)
+                out[i + 1] = disp & 0xFF
+                i += 2
+            elif count <= 0x11 + 0xFF:
+                count -= 0x11
+                assert 0 <= count <= 0xFF
+                out[i] = count >> 4
+                out[i + 1] = ((count & 0xF) << 4) | (disp >> 8)
+                out[i + 2] = disp & 0xFF
+                i += 3
+            elif count <= 0x111 + 0xFFFF:
+                count -= 0x111
+                assert 0 <= count <= 0xFFFF
+                out[i] = 0x10 | (count >> 12)
+                out[i + 1] = (count >> 4) & 0xFF
+                out[i + 2] = ((count & 0xF) << 4) | (disp >> 8)
+                out[i + 3] = disp & 0xFF
+                i += 4
             else:
-                if isinstance(t, str):
-                    out.write(t)
-                else:
-                    out.write(pack(">B", t))
+                raise ValueError(count)
+        else:
+            out[i] = t
+            i += 1
 
-        length += 1
-        length += sum(2 if f else 1 for f in flags)
+        flag >>= 1
 
     # padding
-    padding = 4 - (length % 4 or 4)
-    if padding:
-        out.write(b'\xff' * padding)
+    padding = _padding(i)
+    out[i:i + padding] = b'\xff' * padding
+    del out[i + padding:]
+
+    return bytes(out)
+
+def estimate_size(input, fmt='lz10', max_chain=8):
+    """Returns the size compress_bytes() would produce for input, estimated by
+    a greedy parse that only looks at the max_chain most recent candidates of
+    each search and doesn't encode anything."""
+    compression_type, windowclass = FORMATS[fmt]
+    input = _tobytes(input)
+
+    if windowclass is None:
+        size = 4 + len(input)
+        return size + _padding(size)
+
+    window = windowclass(input, max_chain)
+    tokens = 0
+    size = 4
+    for t in _parse_greedy(input, window):
+        tokens += 1
+        if type(t) == tuple:
+            size += (window.match_cost(t[0]) - 1) // 8
+        else:
+            size += 1
 
-def compress_nlz11(input, out):
-    # header
-    out.write(pack("<L", (len(input) << 8) + 0x11))
+    # flag bytes
+    size += (tokens + 7) // 8
+    return size + _padding(size)
 
-    # body
-    length = 0
-    for tokens in chunkit(_compress(input, windowclass=NLZ11Window), 8):
-        flags = [type(t) == tuple for t in tokens]
-        out.write(pack(">B", packflags(flags)))
-        length += 1
+def select_format(input, formats=AUTO_FORMATS, prefer='size'):
+    """Picks the format of formats for input by estimated size. Returns a
+    (format, estimates) tuple, estimates being a dict of format to estimated
+    size.
 
-        for t in tokens:
-            if type(t) == tuple:
-                count, disp = t
-                disp = (-disp) - 1
-                #if disp == 282:
-                #    raise Exception
-                assert 0 <= disp <= 0xFFF
-                if count <= 1 + 0xF:
-                    count -= 1
-                    assert 2 <= count <= 0xF
-                    sh = (count << 12) | disp
-                    out.write(pack(">H", sh))
-                    length += 2
-                elif count <= 0x11 + 0xFF:
-                    count -= 0x11
-                    assert 0 <= count <= 0xFF
-                    b = count >> 4
-                    sh = ((count & 0xF) << 12) | disp
-                    out.write(pack(">BH", b, sh))
-                    length += 3
-                elif count <= 0x111 + 0xFFFF:
-                    count -= 0x111
-                    assert 0 <= count <= 0xFFFF
-                    l = (1 << 28) | (count << 12) | disp
-                    out.write(pack(">L", l))
-                    length += 4
-                else:
-                    raise ValueError(count)
-            else:
-                out.write(pack(">B", t))
-                length += 1
+    prefer='size' picks the smallest format, prefer='speed' the fastest to
+    decode one within SPEED_SLACK of the smallest."""
+    estimates = dict((fmt, estimate_size(input, fmt)) for fmt in formats)
+    smallest = min(estimates.values())
 
-    # padding
-    padding = 4 - (length % 4 or 4)
-    if padding:
-        out.write(b'\xff' * padding)
+    if prefer == 'size':
+        limit = smallest
+    elif prefer == 'speed':
+        limit = smallest * (1 + SPEED_SLACK)
+    else:
+        raise ValueError("Unknown preference %r" % (prefer,))
+
+    candidates = [fmt for fmt in formats if estimates[fmt] <= limit]
+    return min(candidates, key=DECODE_ORDER.index), estimates
+
+def compress_auto(input, formats=AUTO_FORMATS, prefer='size', level=GREEDY, max_chain=None):
+    """Compresses input with the format picked by select_format(). Returns a
+    (format, data, estimates) tuple."""
+    input = _tobytes(input)
+    fmt, estimates = select_format(input, formats, prefer)
+    data = compress_bytes(input, fmt, level, max_chain=max_chain)
+
+    # The estimate may be off for data that barely compresses
+    if fmt != 'raw' and 'raw' in formats and estimates['raw'] < len(data):
+        fmt = 'raw'
+        data = compress_bytes(input, fmt)
+
+    return fmt, data, estimates
+
+def compress(input, out, level=GREEDY, workers=None, max_chain=None):
+    out.write(compress_bytes(input, 'lz10', level, workers, max_chain))
+
+def compress_nlz11(input, out, level=GREEDY, workers=None, max_chain=None):
+    out.write(compress_bytes(input, 'lz11', level, workers, max_chain))
 
 def dump_compress_nlz11(input, out):
     # body
@@ -250,11 +784,147 @@ def dump_compress_nlz11(input, out):
     from pprint import pprint
     pprint(list(dump()))
 
+def write_atomic(path, data):
+    """Writes data to path through a temporary file in the same directory, so
+    the file is either left as it was or completely written."""
+    directory, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(prefix='.' + name, suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp() makes the file private, give it the mode of the file it
+        # replaces or of a new file
+        os.chmod(temp, _file_mode(path))
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
+def _file_mode(path):
+    """Returns the permission bits of the file at path, or the ones a new file
+    gets with the current umask"""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except EnvironmentError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def _compress_file(job):
+    """Compresses one (input, output, format, level, max_chain, cache) job.
+    Returns a tuple of (input, output, input size, output size, seconds, error
+    message, cache hit)."""
+    path, output, fmt, level, max_chain, cache = job
+    if not cache:
+        lzcache.disable()
+    hits = _cache_hits()
+    start = time.time()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        compressed = compress_bytes(data, fmt, level, max_chain=max_chain)
+        write_atomic(output, compressed)
+    except (EnvironmentError, ValueError) as e:
+        return path, output, None, None, time.time() - start, str(e), False
+    return path, output, len(data), len(compressed), time.time() - start, None, _cache_hits() > hits
+
+def _cache_hits():
+    cache = lzcache.default()
+    return cache.hits if cache else 0
+
+def compress_files(jobs, workers=None):
+    """Compresses (input, output, format, level, max_chain, cache) jobs in a pool of worker
+    processes and yields their results in the same order, see
+    _compress_file()."""
+    if workers == 1:
+        for job in jobs:
+            yield _compress_file(job)
+        return
+
+    for result in _pool_map(_compress_file, jobs, workers):
+        yield result
+
+def _batch_inputs(paths, stdin):
+    """Expands command line inputs to (path, name) pairs, name being the path
+    the output is named after, relative to the output directory."""
+    if paths == ['-']:
+        paths = [line.strip() for line in stdin if line.strip()]
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    yield full, os.path.relpath(full, path)
+        else:
+            yield path, os.path.basename(path)
+
+def main(argv=None):
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Compress files with Nintendo DS LZ10/LZ11. A single file is '
+        'written to stdout, anything else is compressed in batch mode next to the inputs or into --output')
+    parser.add_argument('inputs', help="files or directories to compress, '-' reads a list of paths from stdin", nargs='+')
+    parser.add_argument('-f', '--format', help='compression format', choices=('lz10', 'lz11'), default='lz11')
+    parser.add_argument('-l', '--level', help='compression level: 0 - greedy, 1 - lazy, 2 - optimal', type=int,
+        choices=(GREEDY, LAZY, OPTIMAL), default=GREEDY)
+    parser.add_argument('--max-chain', help='most candidates each match search looks at, faster but larger '
+        'output, all of them by default', type=int)
+    parser.add_argument('-o', '--output', help='directory to write compressed files to')
+    parser.add_argument('-s', '--suffix', help='suffix of compressed files, .<format> by default')
+    parser.add_argument('--no-cache', help="don't use the cache of compressed files", action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of worker processes, all cores by default in batch mode; '
+        'a single file is split across them', type=int)
+    args = parser.parse_args(argv)
+
+    if args.no_cache:
+        lzcache.disable()
+
+    if len(args.inputs) == 1 and args.inputs[0] != '-' and not args.output and os.path.isfile(args.inputs[0]):
+        with open(args.inputs[0], 'rb') as f:
+            data = f.read()
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(compress_bytes(data, args.format, args.level, args.jobs, args.max_chain))
+        return 0
+
+    suffix = args.suffix if args.suffix is not None else '.' + args.format
+    jobs = []
+    for path, name in _batch_inputs(args.inputs, sys.stdin):
+        if args.output:
+            output = os.path.join(args.output, name + suffix)
+            if not os.path.isdir(os.path.dirname(output)):
+                os.makedirs(os.path.dirname(output))
+        else:
+            output = path + suffix
+        jobs.append((path, output, args.format, args.level, args.max_chain, not args.no_cache))
+
+    failed = 0
+    hits = 0
+    total_in = total_out = 0
+    start = time.time()
+    for path, output, in_size, out_size, seconds, error, cached in compress_files(jobs, args.jobs):
+        hits += cached
+        if error:
+            failed += 1
+            print('{}: {}'.format(path, error), file=stderr)
+            continue
+        total_in += in_size
+        total_out += out_size
+        print('{} -> {}: {} -> {} bytes ({:.1%}) in {:.2f}s'.format(path, output, in_size, out_size,
+            out_size / float(in_size or 1), seconds))
+
+    print('{} files, {} -> {} bytes ({:.1%}) in {:.2f}s, {} failed'.format(len(jobs), total_in, total_out,
+        total_out / float(total_in or 1), time.time() - start, failed))
+    if not args.no_cache:
+        print('Compression cache: {} hits, {} misses'.format(hits, len(jobs) - failed - hits))
+    return 1 if failed else 0
+
 if __name__ == '__main__':
-    from sys import stdout, argv
-    data = open(argv[1], "rb").read()
-    stdout = stdout.detach()
-    #compress(data, stdout)
-    compress_nlz11(data, stdout)
+    import sys
+    sys.exit(main())
 
     #dump_compress_nlz11(data, stdout)
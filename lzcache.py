@@ -0,0 +1,153 @@
+# On-disk cache of compressed blocks, so unchanged tiles and parts aren't
+# compressed again on every update
+from __future__ import print_function
+
+import hashlib
+import os
+import sqlite3
+import time
+from sys import stderr
+
+DEFAULT_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'sonic-rush-tools', 'lz77.sqlite')
+
+# Total size of cached blocks above which the least recently used ones are
+# dropped
+DEFAULT_MAX_SIZE = 256 << 20
+
+# Blocks put between recounts of the total size, which other processes
+# change too
+RECOUNT_INTERVAL = 64
+
+# Part of every key, bumped whenever the compressors write something else
+# for the same input so blocks stored by older versions aren't returned
+VERSION = 3
+
+# Set to False to neither look up nor store anything, e.g. for --no-cache
+enabled = True
+
+class Cache(object):
+    """A SQLite store of compressed blocks with LRU eviction"""
+    def __init__(self, path=DEFAULT_PATH, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.pid = None
+        # Running total size of the stored blocks, recounted now and then
+        self.total = None
+        self.puts = 0
+
+    def connect(self):
+        # A connection can't be shared with forked worker processes
+        if self.db is None or self.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+
+            self.db = sqlite3.connect(self.path, timeout=30)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS blocks '
+                '(key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)')
+            self.pid = os.getpid()
+            self.total = None
+        return self.db
+
+    @staticmethod
+    def key(data, codec, windowclass, level, max_chain=None):
+        """Returns the cache key for data compressed with codec, windowclass
+        and level, with searches limited to max_chain candidates"""
+        digest = hashlib.sha1(bytes(data)).hexdigest()
+        name = windowclass.__name__ if windowclass else ''
+        return 'v{}:{}:{}:{}:{}:{}'.format(VERSION, digest, codec, name, level, max_chain or '')
+
+    def get(self, key):
+        """Returns the block stored under key or None"""
+        db = self.connect()
+        row = db.execute('SELECT data FROM blocks WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        with db:
+            db.execute('UPDATE blocks SET used = ? WHERE key = ?', (time.time(), key))
+        return bytes(row[0])
+
+    def put(self, key, data):
+        db = self.connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO blocks (key, data, size, used) VALUES (?, ?, ?, ?)',
+                (key, sqlite3.Binary(data), len(data), time.time()))
+
+            # Summing the sizes is a scan of the whole table, so it's only done
+            # every RECOUNT_INTERVAL blocks or when the total looks too large
+            self.puts += 1
+            if self.total is None or not self.puts % RECOUNT_INTERVAL:
+                self.total = self.size(db)
+            else:
+                self.total += len(data)
+            if self.total > self.max_size:
+                self.evict(db)
+
+    def size(self, db):
+        """Returns the total size of the stored blocks"""
+        return db.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchone()[0]
+
+    def evict(self, db):
+        """Drops the least recently used blocks until the total size is within
+        max_size"""
+        total = self.total = self.size(db)
+        if total <= self.max_size:
+            return
+
+        for key, size in db.execute('SELECT key, size FROM blocks ORDER BY used').fetchall():
+            db.execute('DELETE FROM blocks WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+        self.total = total
+
+    def stats(self):
+        return 'Compression cache: {} hits, {} misses'.format(self.hits, self.misses)
+
+_default = None
+
+def default():
+    """Returns the process-wide cache or None if caching is disabled"""
+    global _default
+    if not enabled:
+        return None
+    if _default is None:
+        _default = Cache()
+    try:
+        _default.connect()
+    except (sqlite3.Error, EnvironmentError) as e:
+        print('Compression cache disabled: {}'.format(e), file=stderr)
+        disable()
+        return None
+    return _default
+
+def disable():
+    global enabled
+    enabled = False
+
+def counts():
+    """Returns the hits and misses of the process-wide cache so far"""
+    if _default is None:
+        return 0, 0
+    return _default.hits, _default.misses
+
+def stats():
+    """Returns the hit/miss counters of the process-wide cache as a string, or
+    None if it wasn't used"""
+    if _default is None or not (_default.hits or _default.misses):
+        return None
+    return _default.stats()
@@ -0,0 +1,33 @@
+# Conversion of 15-bit BGR555 palettes to 8-bit RGB ones, through precomputed
+# lookup tables
+from struct import unpack
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 8-bit value of each 5-bit color level
+LEVELS = [int(n * (255 / 31.0)) for n in range(32)]
+
+# RGB of each BGR555 color, the top bit is ignored
+TABLE = [(red, green, blue) for blue in LEVELS for green in LEVELS for red in LEVELS]
+
+if numpy is not None:
+    colors = numpy.arange(1 << 15)
+    TABLE_ARRAY = numpy.array(LEVELS, dtype=numpy.uint8)[
+        numpy.stack((colors & 31, colors >> 5 & 31, colors >> 10 & 31), axis=-1)]
+    del colors
+
+def decode_palette(palette_data):
+    """Converts BGR555 colors to a flat list of RGB values"""
+    n = len(palette_data) // 2
+
+    if numpy is not None:
+        colors = numpy.frombuffer(palette_data, dtype='<u2', count=n)
+        return TABLE_ARRAY[colors & 0x7FFF].ravel().tolist()
+
+    palette = []
+    for color in unpack('<{}H'.format(n), palette_data[:n * 2]):
+        palette.extend(TABLE[color & 0x7FFF])
+    return palette
@@ -2,10 +2,10 @@
 import argparse
 import csv
 import os
-from struct import pack
 from PIL import Image, ImageDraw, ImageFont
 import bb_bbg
 import bbg
+from bbg import write_bb
 
 parser = argparse.ArgumentParser(description='Render translated text from csv file to Sonic Rush bb/bbg')
 parser.add_argument('mode', help='output mode', choices=['talk_m', 'msg_c', 'msg_t'])
@@ -111,24 +111,9 @@ for n, row in enumerate(reader):
 
 if args.mode == 'talk_m':
     with open('talk_m_rus.bb', 'wb') as bb:
-        bb.write('BB\x00\x00')
-        # Write len of files
-        bb.write(pack('<i', len(bbgs)))
-        
-        # Write files info and data
-        offset = len(bbgs) * 8 + 8
+        write_bb(bb, bbgs)
         
+    if args.bbg:
         for n, bbg in enumerate(bbgs):
-            # Write info
-            bb.write(pack('<ii', offset, len(bbg)))
-            next_entry = bb.tell()
-            
-            bb.seek(offset)
-            bb.write(bbg)
-            offset = bb.tell()
-            
-            bb.seek(next_entry)
-            
-            if args.bbg:
-                with open('{}_{:03}.bbg'.format('talk_m_rus', n), 'wb') as output:
-                    output.write(bbg)
\ No newline at end of file
+            with open('{}_{:03}.bbg'.format('talk_m_rus', n), 'wb') as output:
+                output.write(bbg)
\ No newline at end of file
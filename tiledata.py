@@ -0,0 +1,262 @@
+# Decoding of 8x8 tiles of 4 bpp (color_format 1) and 8 bpp (color_format 2)
+# data, vectorized with NumPy when it's installed
+from struct import unpack
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAVE_NUMPY = numpy is not None
+
+def bytes_per_tile(color_format):
+    return 32 if color_format == 1 else 64
+
+def decode_tiles(data, color_format):
+    """Returns the color indices of the tiles in data, as an (n, 8, 8) uint8
+    array, or as a list of 64-item lists of rows without NumPy"""
+    size = bytes_per_tile(color_format)
+    n = len(data) // size
+
+    if numpy is not None:
+        raw = numpy.frombuffer(data, dtype=numpy.uint8, count=n * size)
+        if color_format == 1:
+            # Two pixels per byte, low nibble first
+            pixels = numpy.empty(n * 64, dtype=numpy.uint8)
+            pixels[0::2] = raw & 0x0F
+            pixels[1::2] = raw >> 4
+        else:
+            pixels = raw
+        return pixels.reshape(n, 8, 8)
+
+    raw = bytearray(data)
+    tiles = []
+    for i in range(0, n * size, size):
+        if color_format == 1:
+            pixels = []
+            for value in raw[i:i + size]:
+                pixels += [value & 0x0F, value >> 4]
+        else:
+            pixels = list(raw[i:i + size])
+        tiles.append(pixels)
+    return tiles
+
+def _tile_bytes(tile):
+    if numpy is not None:
+        return tile.tobytes()
+    return bytes(bytearray(tile))
+
+def tiles_to_images(tiles):
+    """Returns a separate 8x8 'P' image for each of decoded tiles"""
+    return [Image.frombytes('P', (8, 8), _tile_bytes(tile)) for tile in tiles]
+
+def arrange_tiles(tiles, width, height):
+    """Returns a width x height 'P' image with decoded tiles laid out in rows,
+    left to right. Missing tiles are left blank, extra ones are dropped."""
+    columns, rows = width // 8, height // 8
+    count = min(len(tiles), columns * rows)
+
+    if numpy is not None:
+        grid = numpy.zeros((rows * columns, 8, 8), dtype=numpy.uint8)
+        grid[:count] = tiles[:count]
+        pixels = grid.reshape(rows, columns, 8, 8).swapaxes(1, 2)
+        return Image.frombytes('P', (width, height), pixels.tobytes())
+
+    image = Image.new('P', (width, height))
+    for index, tile in enumerate(tiles_to_images(tiles[:count])):
+        image.paste(tile, ((index % columns) * 8, (index // columns) * 8))
+    return image
+
+def compose_map(tiles, mappings_data, offset, row_len, rows_n, palette_index=None):
+    """Returns the (row_len * 8) x (rows_n * 8) 'P' image of a BG map, given
+    its decoded tiles and its 16-bit screen entries in mappings_data. Entries
+    refer to tiles from VRAM tile number offset on; ones past the decoded
+    tiles are left blank. With palette_index given, tiles of a higher palette
+    bank get their colors moved 16 up per bank past it.
+
+    Needs NumPy: entries are split into index arrays, tiles are gathered
+    from their four pre-flipped variants in one step, and the image is made
+    with a single frombytes."""
+    words = numpy.frombuffer(mappings_data, dtype='<u2', count=len(mappings_data) // 2)
+    count = min(len(words), row_len * rows_n)
+    words = words[:count]
+
+    n = (words & 0x03FF).astype(numpy.intp) - offset
+    flips = ((words >> 10) & 1) | (((words >> 11) & 1) << 1)
+    banks = (words >> 12).astype(numpy.intp)
+
+    # Negative tile numbers count from the end of the tiles like list indices
+    tiles_n = len(tiles)
+    valid = (n < tiles_n) & (n >= -tiles_n)
+    n = numpy.where(n < 0, n + tiles_n, n)
+
+    screen = numpy.zeros((row_len * rows_n, 8, 8), dtype=numpy.uint8)
+    if tiles_n:
+        # Unflipped, flipped horizontally, vertically and both
+        variants = numpy.stack((tiles, tiles[:, :, ::-1], tiles[:, ::-1, :], tiles[:, ::-1, ::-1]))
+        gathered = variants[flips[valid], n[valid]]
+
+        if palette_index is not None:
+            # Colors past the end of the palette stay at its last one
+            shifts = numpy.maximum(banks[valid] - palette_index, 0) * 16
+            gathered = numpy.minimum(gathered + shifts[:, None, None], 255).astype(numpy.uint8)
+
+        screen[:count][valid] = gathered
+
+    pixels = screen.reshape(rows_n, row_len, 8, 8).swapaxes(1, 2)
+    return Image.frombytes('P', (row_len * 8, rows_n * 8), pixels.tobytes())
+
+def image_tiles(image):
+    """Generates the 8x8 tiles of a 'P' (or 'L') image, in rows, as tuples of
+    the packed tile bytes unflipped, flipped horizontally, vertically and
+    both ways. Edges that don't fill a whole tile are padded with color 0."""
+    width, height = image.size
+    columns, rows = -(-width // 8), -(-height // 8)
+
+    if numpy is not None:
+        pixels = numpy.zeros((rows * 8, columns * 8), dtype=numpy.uint8)
+        pixels[:height, :width] = numpy.frombuffer(image.tobytes(), dtype=numpy.uint8).reshape(height, width)
+        blocks = pixels.reshape(rows, 8, columns, 8).swapaxes(1, 2).reshape(rows * columns, 8, 8)
+        for tile in blocks:
+            yield (tile.tobytes(), tile[:, ::-1].tobytes(), tile[::-1, :].tobytes(), tile[::-1, ::-1].tobytes())
+        return
+
+    pixels = bytearray(image.tobytes())
+    for y in range(0, rows * 8, 8):
+        for x in range(0, columns * 8, 8):
+            lines = []
+            for line_y in range(y, y + 8):
+                line = pixels[line_y * width + x:line_y * width + min(x + 8, width)] if line_y < height else bytearray()
+                lines.append(bytes(line + bytearray(8 - len(line))))
+            mirrored = [line[::-1] for line in lines]
+            yield (b''.join(lines), b''.join(mirrored), b''.join(lines[::-1]), b''.join(mirrored[::-1]))
+
+def sample_grid(width, height, region=None, thumbnail=None):
+    """Returns the columns and rows of the pixels of a width x height map
+    shown for region=(x, y, w, h), clipped to the map, scaled down by
+    skipping pixels to fit within thumbnail=(width, height) if given"""
+    x, y, w, h = region or (0, 0, width, height)
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + w, width), min(y + h, height)
+    if left >= right or top >= bottom:
+        raise ValueError('Region {} is outside of the {}x{} map'.format(region, width, height))
+
+    step = 1
+    if thumbnail:
+        step = max(-(-(right - left) // thumbnail[0]), -(-(bottom - top) // thumbnail[1]), 1)
+    return range(left, right, step), range(top, bottom, step)
+
+def sample_map(data, color_format, mappings_data, offset, row_len, rows_n, xs, ys, palette_index=None):
+    """Returns the len(xs) x len(ys) 'P' image of the pixels at columns xs
+    and rows ys of what compose_map draws, given the tile data itself. Only
+    the screen entries under those pixels and the tiles they use are decoded,
+    so the cost follows the size of the result rather than of the map."""
+    size = bytes_per_tile(color_format)
+    tiles_n = len(data) // size
+    count = min(len(mappings_data) // 2, row_len * rows_n)
+    width, height = len(xs), len(ys)
+
+    if numpy is not None:
+        xs = numpy.asarray(xs, dtype=numpy.intp)
+        ys = numpy.asarray(ys, dtype=numpy.intp)[:, None]
+
+        # Screen entry under each pixel, entries past the mappings read the
+        # zero added after them
+        entries = (ys // 8) * row_len + xs // 8
+        present = entries < count
+        words = numpy.append(numpy.frombuffer(mappings_data, dtype='<u2', count=count), 0)
+        words = words[numpy.where(present, entries, count)]
+
+        n = (words & 0x03FF).astype(numpy.intp) - offset
+        valid = present & (n < tiles_n) & (n >= -tiles_n)
+        n = numpy.where(n < 0, n + tiles_n, n)
+
+        # Flips just mirror the position of the pixel within its tile
+        tile_x = numpy.where(words & 0x400, 7 - xs % 8, xs % 8)
+        tile_y = numpy.where(words & 0x800, 7 - ys % 8, ys % 8)
+
+        pixels = numpy.zeros((height, width), dtype=numpy.uint8)
+        used, index = numpy.unique(n[valid], return_inverse=True)
+        if len(used):
+            raw = numpy.frombuffer(data, dtype=numpy.uint8, count=tiles_n * size).reshape(tiles_n, size)
+            tiles = decode_tiles(raw[used].tobytes(), color_format)
+            values = tiles[index, tile_y[valid], tile_x[valid]]
+
+            if palette_index is not None:
+                shifts = numpy.maximum((words[valid] >> 12).astype(numpy.intp) - palette_index, 0) * 16
+                values = numpy.minimum(values + shifts, 255).astype(numpy.uint8)
+
+            pixels[valid] = values
+        return Image.frombytes('P', (width, height), pixels.tobytes())
+
+    words = unpack('<{}H'.format(count), mappings_data[:count * 2])
+    tiles = {}
+    pixels = bytearray(width * height)
+    i = 0
+    for y in ys:
+        row = (y // 8) * row_len
+        for x in xs:
+            entry = row + x // 8
+            if entry < count:
+                value = words[entry]
+                n = (value & 0x03FF) - offset
+                if -tiles_n <= n < tiles_n:
+                    n %= tiles_n
+                    if n not in tiles:
+                        tiles[n] = decode_tiles(data[n * size:(n + 1) * size], color_format)[0]
+
+                    tile_x = 7 - x % 8 if value & 0x400 else x % 8
+                    tile_y = 7 - y % 8 if value & 0x800 else y % 8
+                    pixel = tiles[n][tile_y * 8 + tile_x]
+
+                    if palette_index is not None and value >> 12 > palette_index:
+                        pixel = min(pixel + ((value >> 12) - palette_index) * 16, 255)
+                    pixels[i] = pixel
+            i += 1
+    return Image.frombytes('P', (width, height), bytes(pixels))
+
+def canonical_keys(tiles):
+    """Returns a key for each of decoded tiles that is the same for all its
+    flipped variants: the smallest of their packed bytes"""
+    if numpy is not None:
+        return [min(tile.tobytes(), tile[:, ::-1].tobytes(), tile[::-1, :].tobytes(), tile[::-1, ::-1].tobytes())
+            for tile in tiles]
+
+    keys = []
+    for tile in tiles:
+        lines = [bytes(bytearray(tile[i:i + 8])) for i in range(0, 64, 8)]
+        mirrored = [line[::-1] for line in lines]
+        keys.append(min(b''.join(lines), b''.join(mirrored), b''.join(lines[::-1]), b''.join(mirrored[::-1])))
+    return keys
+
+def order_tiles(tiles, fixed=1):
+    """Returns an order of packed tiles that puts similar ones next to each
+    other, so more of them are within reach of LZ back references. The first
+    fixed tiles keep their places, then each next one is the remaining tile
+    with the most bytes equal to the previous one, the first such on ties."""
+    n = len(tiles)
+    fixed = max(fixed, 1)
+    order = list(range(min(fixed, n)))
+
+    if numpy is not None and n > fixed:
+        rows = numpy.frombuffer(b''.join(tiles), dtype=numpy.uint8).reshape(n, -1)
+        taken = numpy.zeros(n, dtype=bool)
+        taken[:fixed] = True
+        current = fixed - 1
+        for _ in range(n - fixed):
+            scores = (rows == rows[current]).sum(axis=1)
+            scores[taken] = -1
+            current = int(scores.argmax())
+            taken[current] = True
+            order.append(current)
+        return order
+
+    rows = [bytearray(tile) for tile in tiles]
+    left = list(range(fixed, n))
+    while left:
+        previous = rows[order[-1]]
+        current = max(left, key=lambda i: sum(a == b for a, b in zip(rows[i], previous)))
+        left.remove(current)
+        order.append(current)
+    return order
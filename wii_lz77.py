@@ -1,45 +1,76 @@
 # From http://wiibrew.org/wiki/LZ77
 import sys, struct
- 
+
+def max_compressed_size(uncompressed_length):
+    """Returns the longest LZ10 body, without header, that can decode to
+    uncompressed_length bytes: all literals plus their flag bytes"""
+    return uncompressed_length + (uncompressed_length + 7) // 8
+
+def uncompress_lz10(data, uncompressed_length, start=0):
+    """Decodes an LZ10 body starting at start of data (a byte string, buffer
+    or memoryview) into uncompressed_length bytes"""
+    src = bytearray(data)
+    out = bytearray(uncompressed_length)
+    src_len = len(src)
+    i = start
+    o = 0
+
+    try:
+        while o < uncompressed_length:
+            if i >= src_len:
+                raise ValueError("Compressed data ends after {} of {} bytes".format(o, uncompressed_length))
+            flags = src[i]
+            i += 1
+
+            for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+                if flags & bit:
+                    info = (src[i] << 8) | src[i + 1]
+                    i += 2
+                    num = min(3 + (info >> 12), uncompressed_length - o)
+                    disp = (info & 0xFFF) + 1
+                    ptr = o - disp
+                    if ptr < 0:
+                        raise ValueError("Back reference before the start of data at {}".format(o))
+
+                    if disp >= num:
+                        out[o:o + num] = out[ptr:ptr + num]
+                    else:
+                        # The reference overlaps the bytes it produces, so they
+                        # repeat its first disp bytes
+                        out[o:o + num] = (out[ptr:o] * (num // disp + 1))[:num]
+                    o += num
+                else:
+                    out[o] = src[i]
+                    i += 1
+                    o += 1
+
+                if o >= uncompressed_length:
+                    break
+    except IndexError:
+        # A token is cut short
+        raise ValueError("Compressed data ends after {} of {} bytes".format(o, uncompressed_length))
+
+    return bytes(out)
+
 class WiiLZ77:
     TYPE_LZ77 = 1
     def __init__(self, file, offset):
         self.file = file
         self.offset = offset
- 
+
         self.file.seek(self.offset)
- 
+
         hdr = struct.unpack("<I",self.file.read(4))[0]
         self.uncompressed_length = hdr>>8
         self.compression_type = hdr>>4 & 0xF
- 
+
         if self.compression_type != self.TYPE_LZ77:
             raise ValueError("Unsupported compression method %d"%self.compression_type)
- 
+
     def uncompress(self):
-        dout = ""
- 
+        # Read the whole compressed span at once
         self.file.seek(self.offset + 0x4)
- 
-        while len(dout) < self.uncompressed_length:
-            flags = struct.unpack("<B",self.file.read(1))[0]
- 
-            for i in range(8):
-                if flags & 0x80:
-                    info = struct.unpack(">H",self.file.read(2))[0]
-                    num = 3 + ((info>>12)&0xF)
-                    disp = info & 0xFFF
-                    ptr = len(dout) - (info & 0xFFF) - 1
-                    for i in range(num):
-                        dout += dout[ptr]
-                        ptr+=1
-                        if len(dout) >= self.uncompressed_length:
-                            break
-                else:
-                    dout += self.file.read(1)
-                flags <<= 1
-                if len(dout) >= self.uncompressed_length:
-                    break
- 
-        self.data = dout
-        return self.data
\ No newline at end of file
+        data = self.file.read(max_compressed_size(self.uncompressed_length))
+
+        self.data = uncompress_lz10(data, self.uncompressed_length)
+        return self.data